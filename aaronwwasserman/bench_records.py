@@ -0,0 +1,41 @@
+# Compares the cached size and decode cost of pickled db.Model instances with
+# the compact records in blogrecords.py, per cache hit.
+#
+# Run with the App Engine SDK on the path:
+#   PYTHONPATH=$GAE_SDK python bench_records.py
+
+import cPickle
+import time
+import timeit
+
+from datetime import datetime
+
+import blogmodels
+import blogpasswords
+import blogrecords
+
+
+def report(name, pickled, encoded, decode_pickled, decode_encoded, number=2000):
+	pickled_time = timeit.timeit(decode_pickled, number=number) / number * 1e6
+	encoded_time = timeit.timeit(decode_encoded, number=number) / number * 1e6
+
+	print '%-6s pickled: %6d bytes %7.1f us/hit' % (name, len(pickled), pickled_time)
+	print '%-6s record:  %6d bytes %7.1f us/hit' % (name, len(encoded), encoded_time)
+	print '%-6s saved:   %6d bytes (%.0f%%)' % (name, len(pickled) - len(encoded),
+											   100.0 * (len(pickled) - len(encoded)) / len(pickled))
+
+
+if __name__ == '__main__':
+	user = blogmodels.User(username=u'aaron', password=blogpasswords.make_password(u'secret'))
+	user_pickled = cPickle.dumps(user, cPickle.HIGHEST_PROTOCOL)
+	user_encoded = blogrecords.encode_user(blogrecords.UserRecord(1, user.username, user.salt, user.password))
+	report('user', user_pickled, user_encoded,
+		   lambda: cPickle.loads(user_pickled), lambda: blogrecords.decode_user(user_encoded))
+
+	blog = blogmodels.Blog(subject=u'Sample post', content=u'Some blog content. ' * 50, author=u'aaron',
+						   created=datetime.utcnow())
+	blog_pickled = cPickle.dumps(blog, cPickle.HIGHEST_PROTOCOL)
+	blog_encoded = blogrecords.encode_blog(blogrecords.BlogRecord(1, blog.subject, blog.content, blog.author,
+																  blog.created, time.time(), blogrecords.post_json(blog, 1)))
+	report('blog', blog_pickled, blog_encoded,
+		   lambda: cPickle.loads(blog_pickled), lambda: blogrecords.decode_blog(blog_encoded))
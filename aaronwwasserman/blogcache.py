@@ -0,0 +1,364 @@
+import cPickle
+import os
+import time
+import threading
+
+from google.appengine.api import memcache
+
+
+# Size-aware memcache storage for values that may outgrow a single entry.
+#
+# A value is pickled and split into chunks below memcache's 1MB value limit.
+# The entry under the key itself holds (generation, chunk count, first chunk);
+# the remaining chunks live under keys derived from the key and the generation
+# and are read back with a single get_multi. Each write picks a fresh random
+# generation, so a reader can never stitch together chunks of two different
+# writes: a missing or mismatched chunk reads as a miss.
+#
+# The header entry is the only one ever replaced in place, which keeps
+# gets/cas on it meaningful for callers doing compare-and-set.
+
+CHUNK_SIZE = 950000
+
+
+def chunk_key(key, generation, index):
+	return '%s:%s:%d' % (key, generation, index)
+
+
+def get_chunked(key, client=None):
+	client = client or memcache.Client()
+	header = client.gets(key)
+
+	if not isinstance(header, tuple) or len(header) != 3:
+		return None
+
+	generation, count, data = header
+	chunks = [data]
+
+	if count > 1:
+		keys = [chunk_key(key, generation, i) for i in xrange(1, count)]
+		found = client.get_multi(keys)
+
+		for k in keys:
+			chunk = found.get(k)
+			if not chunk or chunk[0] != generation:
+				# logging.error('--------------->MC PARTIAL -- %s' % key)
+				return None
+			chunks.append(chunk[1])
+
+	return cPickle.loads(''.join(chunks))
+
+
+# mode is 'set', 'add' or 'cas' (the last needs the client get_chunked was called with).
+# expiry is a memcache expiration time. Returns whether the value was stored.
+
+def set_chunked(key, value, mode='set', client=None, expiry=0):
+	client = client or memcache.Client()
+	data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+	generation = os.urandom(6).encode('hex')
+
+	parts = [data[i:i + CHUNK_SIZE] for i in xrange(0, len(data), CHUNK_SIZE)] or ['']
+
+	if len(parts) > 1:
+		rest = dict((chunk_key(key, generation, i), (generation, parts[i])) for i in xrange(1, len(parts)))
+		if client.set_multi(rest, time=expiry):
+			return False
+
+	header = (generation, len(parts), parts[0])
+
+	if mode == 'add':
+		return client.add(key, header, time=expiry)
+	elif mode == 'cas':
+		return client.cas(key, header, time=expiry)
+	else:
+		return client.set(key, header, time=expiry)
+
+
+def delete_chunked(key, client=None):
+	client = client or memcache.Client()
+	return client.delete(key)
+
+
+# Namespaced cache
+#
+# Everything the blog keeps in memcache goes through a Namespace, which gives
+# its keys a common prefix, its entries a TTL and, optionally, chunked storage.
+# An entry past its TTL but within a further `stale` seconds is still returned,
+# flagged stale.
+#
+# get_or_load is single-flight for expensive values: of all the requests that
+# find a key missing or stale, only the one that wins a short lease (a memcache
+# add) runs the load. The others are served the stale value if there is one,
+# or else poll for the winner's value for up to LEASE_WAIT seconds before
+# giving up and loading it themselves. Writers that would otherwise delete such
+# a key call invalidate instead, which keeps the old value around as stale.
+#
+# Every lookup is counted per namespace as a hit, stale hit or miss, along with
+# the time spent in memcache. Counts are kept per instance and added to shared
+# memcache counters every STATS_FLUSH_INTERVAL seconds; get_stats reads them back.
+
+KEY_PREFIX = 'aw_blog_'
+STATS_PREFIX = KEY_PREFIX + 'stats-'
+STATS_FLUSH_INTERVAL = 60
+LEASE_TIME = 10
+LEASE_WAIT = 2.0
+LEASE_POLL = 0.05
+
+HIT = 'hit'
+STALE = 'stale'
+MISS = 'miss'
+STAT_FIELDS = (HIT, STALE, MISS, 'calls', 'us')
+
+NAMESPACES = {}
+
+_stats = {}
+_stats_lock = threading.Lock()
+_last_flush = [time.time()]
+
+
+class Namespace(object):
+	def __init__(self, name, ttl=0, stale=0, chunked=False):
+		self.name = name
+		self.prefix = '%s%s-' % (KEY_PREFIX, name)
+		self.ttl = ttl
+		self.stale = stale
+		self.chunked = chunked
+		NAMESPACES[name] = self
+
+	def key(self, key):
+		return self.prefix + key
+
+	# Entries are stored as (fresh until, value); memcache drops them once the
+	# stale window is over too.
+	def wrap(self, value):
+		return (time.time() + self.ttl if self.ttl else 0, value)
+
+	def expiry(self):
+		return self.ttl + self.stale if self.ttl else 0
+
+
+def unwrap(entry, now):
+	if not isinstance(entry, tuple) or len(entry) != 2 or not isinstance(entry[0], (int, float)):
+		return None, MISS
+
+	fresh_until, value = entry
+	if fresh_until and now >= fresh_until:
+		return value, STALE
+
+	return value, HIT
+
+
+def read(ns, key, client=None):
+	if ns.chunked:
+		return get_chunked(ns.key(key), client)
+	elif client:
+		return client.gets(ns.key(key))
+	else:
+		return memcache.get(ns.key(key))
+
+
+# Returns (value, outcome). Pass a memcache.Client to set the value back with 'cas'.
+
+def lookup(ns, key, client=None):
+	started = time.time()
+	entry = read(ns, key, client)
+
+	now = time.time()
+	value, outcome = unwrap(entry, now)
+	record(ns, {outcome: 1}, now - started)
+
+	return value, outcome
+
+
+def get(ns, key, client=None):
+	return lookup(ns, key, client)[0]
+
+
+# Returns {key: value} for the keys found, fresh or stale. Not for chunked namespaces.
+
+def get_multi(ns, keys):
+	started = time.time()
+	found = memcache.get_multi(keys, key_prefix=ns.prefix)
+	now = time.time()
+
+	values = {}
+	outcomes = dict.fromkeys((HIT, STALE, MISS), 0)
+	for key in keys:
+		value, outcome = unwrap(found.get(key), now)
+		outcomes[outcome] += 1
+		if outcome != MISS:
+			values[key] = value
+
+	record(ns, outcomes, now - started)
+	return values
+
+
+# mode is 'set', 'add' or 'cas' (the last needs the client lookup was called with).
+# Returns whether the value was stored.
+
+def set(ns, key, value, mode='set', client=None):
+	entry = ns.wrap(value)
+
+	if ns.chunked:
+		return set_chunked(ns.key(key), entry, mode, client, ns.expiry())
+
+	client = client or memcache.Client()
+	if mode == 'add':
+		return client.add(ns.key(key), entry, time=ns.expiry())
+	elif mode == 'cas':
+		return client.cas(ns.key(key), entry, time=ns.expiry())
+	else:
+		return client.set(ns.key(key), entry, time=ns.expiry())
+
+
+def set_multi(ns, mapping):
+	entries = dict((key, ns.wrap(value)) for key, value in mapping.iteritems())
+	return memcache.set_multi(entries, key_prefix=ns.prefix, time=ns.expiry())
+
+
+def delete_multi(ns, keys):
+	return memcache.delete_multi(keys, key_prefix=ns.prefix)
+
+
+def delete(ns, key, client=None):
+	if ns.chunked:
+		return delete_chunked(ns.key(key), client)
+	return (client or memcache).delete(ns.key(key))
+
+
+# Marks an entry stale rather than deleting it, so get_or_load keeps serving it
+# while one request reloads it. Only for keys read through get_or_load.
+
+def invalidate(ns, key, client=None):
+	client = client or memcache.Client()
+	entry = read(ns, key, client)
+
+	if unwrap(entry, time.time())[1] == MISS:
+		return True
+
+	expired = (1, entry[1])
+	if ns.chunked:
+		return set_chunked(ns.key(key), expired, 'cas', client, ns.expiry())
+	return client.cas(ns.key(key), expired, time=ns.expiry())
+
+
+# Returned by a loader for a value get_or_load should hand back without caching.
+
+class Uncacheable(object):
+	def __init__(self, value):
+		self.value = value
+
+
+# Returns the cached value, single-flight loading it with load() when it's
+# missing or stale (see above). A value of None from load() isn't cached.
+# With decode, the decoded value is returned, and an entry that doesn't decode
+# counts as missing.
+
+def get_or_load(ns, key, load, decode=None):
+	client = memcache.Client()
+	value, outcome = lookup(ns, key, client)
+	found = outcome != MISS
+
+	if found and decode:
+		value = decode(value)
+		if value is None:
+			outcome = MISS
+
+	if outcome == HIT:
+		return value
+
+	lease = ns.key(key) + ':lease'
+	leased = client.add(lease, 1, time=LEASE_TIME)
+
+	if not leased:
+		if outcome == STALE:
+			return value
+
+		value = wait_for(ns, key, lease, decode)
+		if value is not None:
+			return value
+
+	try:
+		value = load()
+		if isinstance(value, Uncacheable):
+			value = value.value
+		elif value is not None:
+			# add on a miss and cas otherwise, so neither clobbers a write-through update
+			set(ns, key, value, 'cas' if found else 'add', client)
+	finally:
+		# only after the value is stored, so waiters never see neither
+		if leased:
+			client.delete(lease)
+
+	return decode(value) if decode and value is not None else value
+
+
+# Polls for the value another request holds the lease to load. Returns None if
+# it doesn't show up in time, or the lease is let go without it.
+
+def wait_for(ns, key, lease, decode=None):
+	deadline = time.time() + LEASE_WAIT
+
+	while time.time() < deadline:
+		time.sleep(LEASE_POLL)
+		value, outcome = unwrap(read(ns, key), time.time())
+
+		if outcome != MISS:
+			value = decode(value) if decode else value
+			if value is not None:
+				return value
+
+		if memcache.get(lease) is None:
+			break
+
+	return None
+
+
+def record(ns, outcomes, seconds):
+	with _stats_lock:
+		counts = _stats.setdefault(ns.name, dict.fromkeys(STAT_FIELDS, 0))
+		for outcome, count in outcomes.iteritems():
+			counts[outcome] += count
+		counts['calls'] += 1
+		counts['us'] += int(seconds * 1000000)
+		due = time.time() - _last_flush[0] >= STATS_FLUSH_INTERVAL
+
+	if due:
+		flush_stats()
+
+
+def flush_stats():
+	with _stats_lock:
+		pending = _stats.copy()
+		_stats.clear()
+		_last_flush[0] = time.time()
+
+	deltas = {}
+	for name, counts in pending.iteritems():
+		for field, count in counts.iteritems():
+			if count:
+				deltas['%s.%s' % (name, field)] = count
+
+	if deltas:
+		memcache.offset_multi(deltas, key_prefix=STATS_PREFIX, initial_value=0)
+
+
+# Returns {namespace: counts} across all instances, with each namespace's hit
+# rate (stale hits included) and average memcache latency in ms.
+
+def get_stats():
+	flush_stats()
+	keys = ['%s.%s' % (name, field) for name in NAMESPACES for field in STAT_FIELDS]
+	counters = memcache.get_multi(keys, key_prefix=STATS_PREFIX)
+
+	stats = {}
+	for name, ns in NAMESPACES.iteritems():
+		counts = dict((field, counters.get('%s.%s' % (name, field), 0)) for field in STAT_FIELDS)
+		lookups = counts[HIT] + counts[STALE] + counts[MISS]
+		counts['hit_rate'] = float(counts[HIT] + counts[STALE]) / lookups if lookups else None
+		counts['avg_ms'] = counts['us'] / 1000.0 / counts['calls'] if counts['calls'] else None
+		counts['ttl'] = ns.ttl
+		counts['stale_ttl'] = ns.stale
+		stats[name] = counts
+
+	return stats
@@ -1,93 +1,274 @@
 import logging
+import os
 import time
-import random
 import hashlib
-import string
+import calendar
+import blogcache
+import blogpasswords
+import blogrecords
+import blogusernames
+import blogutils
 
 from google.appengine.ext import db
-from datetime import timedelta
+from google.appengine.ext import deferred
+from datetime import datetime
+from google.appengine.api import app_identity
 from google.appengine.api import memcache
 
 
-# Used in memcache
-USERNAME_PREFIX = 'aw_blog_user-'
-BLOG_PREFIX = 'aw_blog_postID-'
+# Used in memcache, see blogcache.py
+DAY = 24 * 3600
 
+USERS = blogcache.Namespace('user', ttl=DAY)
+NO_USERS = blogcache.Namespace('nouser', ttl=60)
+POSTS = blogcache.Namespace('postID', ttl=DAY)
+FRONT_PAGES = blogcache.Namespace('front', ttl=3600, stale=DAY)
+ARCHIVE_PAGES = blogcache.Namespace('page', ttl=DAY)
+FEEDS = blogcache.Namespace('feed', ttl=3600, stale=DAY)
+AUTHORS = blogcache.Namespace('author', ttl=DAY)
+FRAGMENTS = blogcache.Namespace('fragment', ttl=DAY)
+
+FRONT_PAGE_SIZE = 10
+FRONT_PAGE_RETRIES = 5
+ARCHIVE_PAGE_SIZE = 10
+MAX_BATCH_POSTS = 100
+AUTHOR_PAGE_SIZE = 10
+AUTHOR_INDEX_SHARDS = 10
+FRAGMENT_FORMAT = 1 # bump when templates/blog_post.html changes
+
+MIGRATION_BATCH_SIZE = 100
+
+
+
+# class Secret(db.Model)
+# Holds the key session tokens are signed with. Created with a random value the
+# first time it's needed and kept in memory per instance after that.
+
+class Secret(db.Model):
+	value = db.StringProperty(required=True)
+	_value = None
+
+
+	@classmethod
+	def get_secret(cls):
+		if not cls._value:
+			secret = Secret.get_or_insert('session', value=os.urandom(32).encode('hex'))
+			cls._value = str(secret.value)
+
+		return cls._value
 
 
 # class User(db.Model)
 # Defines the "User" object for the blog.
 
-# All users will have a username, password, salt (for checking their hashed password),
-# and date created.  Email address is optional.
+# All users will have a username, password hash and date created.  Email address is optional.
+# salt is only set for users whose password predates the KDF hashers and is still MD5.
+
+# Users are keyed by their normalized (lowercased) username, so looking one up
+# or checking a name is free is a key get that can run in a transaction.
+# uid is a stable numeric id for session tokens: users keyed by id before this
+# kept their old id, new users get one allocated at signup.
 
 class User(db.Model):
 	username = db.StringProperty(required=True)
-	salt = db.StringProperty(required=True)
+	uid = db.IntegerProperty()
+	salt = db.StringProperty()
 	password = db.StringProperty()
 	email = db.EmailProperty()
 	created = db.DateTimeProperty(auto_now_add=True)
 
 
+	@classmethod
+	def normalize(cls, username):
+		return username.lower()
+
+
+	@classmethod
+	def key_for(cls, username):
+		return db.Key.from_path('User', 'u:' + cls.normalize(username))
+
+
 	@classmethod
 	def get_user(cls, username):
-		user = memcache.get(USERNAME_PREFIX + username)
+		user = blogrecords.decode_user(blogcache.get(USERS, cls.normalize(username)))
 		if not user:
-			query = User.all()
 			logging.error('DB lookup for username: %s' % username)
-			query.filter("username =", username)
-			user = query.get()
-			if user:
-				memcache.set(USERNAME_PREFIX + user.username, user)
+			entity = User.get(cls.key_for(username)) or cls.get_legacy_user(username)
+			if entity:
+				user = blogrecords.user_record(entity)
+				blogcache.set(USERS, cls.normalize(user.username), blogrecords.encode_user(user))
 
 		return user
 
 
+	# Users stored before name keys, until migrate_user_keys has got to them.
+	# One found here is migrated on the spot.
 	@classmethod
-	def hash_pass(cls, password, salt):
-		return hashlib.md5(salt + password).hexdigest()
+	def get_legacy_user(cls, username):
+		legacy = User.all().filter('username =', username).get()
+		if not legacy or legacy.key().name() is not None:
+			return legacy
+
+		return cls.migrate(legacy)
 
 
+	# Re-keys an id-keyed user by name. The name key is only created if it's
+	# free, in a transaction; if it already belongs to this user (same uid) the
+	# old entity is deleted, otherwise both are kept and it's logged, to be
+	# resolved by hand. Returns the user under the name key, or None.
 	@classmethod
-	def make_salt(cls):
-		return "".join(random.choice(string.letters) for x in xrange(5))
+	def migrate(cls, legacy):
+		migrated = db.run_in_transaction(cls.insert_migrated, legacy)
+
+		if migrated.uid != legacy.key().id():
+			logging.warning('Not migrating user %s (id %d): %s already exists', legacy.username,
+							legacy.key().id(), migrated.username)
+			return None
+
+		legacy.delete()
+		cls.cache_user(migrated)
+		return migrated
+
+
+	@classmethod
+	def insert_migrated(cls, legacy):
+		key = cls.key_for(legacy.username)
+		existing = User.get(key)
+		if existing:
+			return existing
+
+		migrated = User(key=key, username=legacy.username, uid=legacy.key().id(), salt=legacy.salt,
+						password=legacy.password, email=legacy.email, created=legacy.created)
+		migrated.put()
+		return migrated
+
+
+	# Whether a username is taken, for signup checks. Most names asked about don't
+	# exist, so a miss is answered by the shared Bloom filter or a short-lived
+	# negative entry before it ever reaches the datastore.
+	@classmethod
+	def name_taken(cls, username):
+		name = cls.normalize(username)
+		if blogcache.get(NO_USERS, name):
+			return False
+
+		bloom = blogusernames.get_filter(cls.all_usernames)
+		if name not in bloom:
+			return False
+
+		if cls.get_user(username):
+			return True
+
+		blogcache.set(NO_USERS, name, True)
+		return False
+
+
+	# Projection on username rather than key names, so users not yet migrated
+	# to name keys are counted too.
+	@classmethod
+	def all_usernames(cls):
+		query = db.Query(User, projection=('username',))
+		return (cls.normalize(user.username) for user in query.run(batch_size=1000))
 
 
 	@classmethod
 	def insert(cls, user):
 		user.put()
-		memcache.set(USERNAME_PREFIX + user.username, user)
+		cls.cache_user(user)
+
+
+	@classmethod
+	def cache_user(cls, user):
+		blogcache.set(USERS, cls.normalize(user.username), blogrecords.encode_user(blogrecords.user_record(user)))
 
 
+	# Returns None if the username was taken, checked in the same transaction
+	# as the put.
 	@classmethod
 	def create(cls, user_form):
-		user = User(username=user_form.get('username'), salt=cls.make_salt())
-		user.password = cls.hash_pass(user_form.get('password'), user.salt)
+		username = user_form.get('username')
+		user = User(key=cls.key_for(username), username=username)
+		user.password = blogpasswords.make_password(user_form.get('password'))
 		if user_form.get('email'):
 			user.email = user_form.get('email')
 
-		cls.insert(user)
+		user.uid = db.allocate_ids(db.Key.from_path('User', 1), 1)[0]
 
+		if not db.run_in_transaction(cls.insert_new, user):
+			return None
+
+		cls.cache_user(user)
+		blogusernames.add_name(cls.normalize(username))
+		blogcache.delete(NO_USERS, cls.normalize(username))
 		return user
 
 
+	@classmethod
+	def insert_new(cls, user):
+		if User.get(user.key()):
+			return False
+
+		user.put()
+		return True
+
+
+	# Passwords stored with MD5 or an outdated cost are rehashed on a successful login.
 	@classmethod
 	def check_pass(cls, user, password):
 		if user and password:
-			return user.password == cls.hash_pass(password, user.salt)
+			matches, needs_rehash = blogpasswords.check_password(password, user.password, user.salt)
+			if needs_rehash:
+				cls.upgrade_password(user, password)
+			return matches
 		else:
 			return False
 
 
+	@classmethod
+	def upgrade_password(cls, user, password):
+		try:
+			password_hash = blogpasswords.make_password(password)
+		except blogpasswords.HasherBusy:
+			return # try again on the next login
+
+		entity = User.get(user.key())
+		entity.password = password_hash
+		entity.salt = None
+		cls.insert(entity)
+
+
+# migrate_user_keys()
+# One-time migration of users stored before they were keyed by username.
+# Re-keys one batch of id-keyed users (see User.migrate) and defers itself for
+# the next batch. Users are also migrated as they're looked up, so logins work
+# while this runs.
+
+def migrate_user_keys(cursor=None):
+	query = User.all()
+	if cursor:
+		query.with_cursor(cursor)
+
+	users = query.fetch(MIGRATION_BATCH_SIZE)
+	for user in users:
+		if user.key().name() is None:
+			User.migrate(user)
+
+	if len(users) == MIGRATION_BATCH_SIZE:
+		deferred.defer(migrate_user_keys, query.cursor())
+
+
 # class Blog(db.Model)
 # Defines the "Blog" object.
 
-# All blogs will have a subject, content, date created,
-# author, and time delta object for storing last cache point.
+# All blogs will have a subject, content, date created and author.
 
 # Helper methods include:
-# -most_recents: get 10 most recent blogs from memcache (or db)
-# -get_blog: get a single blog by id (from memcache or db)
+# -most_recents: get the FRONT_PAGE_SIZE most recent blogs from memcache (or db)
+# -archive_page: get a page of older blogs by cursor (from memcache or db)
+# -get_blog: get a single blog by id (from memcache or db) as a read-only BlogRecord
+# -get_blogs: get many blogs by id in one batch
+# -get_fragments: get the rendered markup of many blogs in one batch
+# -get_feed: get the Atom feed of the front page
 # -create: creates a new instance of Blog
 
 class Blog(db.Model):
@@ -95,59 +276,174 @@ class Blog(db.Model):
 	content = db.TextProperty(required=True)
 	author = db.StringProperty()
 	created = db.DateTimeProperty(auto_now_add=True)
-	last_cached = timedelta()
-	cache_age = db.IntegerProperty()
 
 	@classmethod
 	def flush_blog(cls, blog_id):
-		memcache.delete(BLOG_PREFIX + blog_id)
+		blogcache.invalidate(POSTS, blog_id)
+		blogcache.delete(FRAGMENTS, cls.fragment_key(blog_id))
 
 
+	# The front page is a materialized list of the newest BlogRecords, so a hit
+	# needs no datastore work. cache_age is the time since it was materialized.
+	# Past its TTL it is rematerialized by one request while the rest are served
+	# the stale page.
 	@classmethod
-	def get_seconds(cls):
-		return timedelta(seconds=time.time())
+	def most_recents(cls):
+		front_page, materialized = blogcache.get_or_load(FRONT_PAGES, 'home', cls.load_front_page,
+														 blogrecords.decode_front_page)
+
+		return front_page, int(time.time() - materialized)
 
 
 	@classmethod
-	def cache_delta(cls, last_cached):
-		now = cls.get_seconds()
-		delta = (now - last_cached).total_seconds()
-		return int(delta)
+	def load_front_page(cls):
+		return blogrecords.encode_front_page(*cls.materialize_front_page())
 
 
+	# Queries the newest posts. new_blog is included even if the (eventually
+	# consistent) query doesn't return it yet.
 	@classmethod
-	def most_recents(cls):
-		front_page = memcache.get('front_page')
+	def materialize_front_page(cls, new_blog=None):
+		query = Blog.all().order('-created')
+		front_page = [blogrecords.blog_record(blog) for blog in query.fetch(FRONT_PAGE_SIZE)]
 
-		if front_page:
-			front_cache = memcache.get('front_cache')
+		if new_blog:
+			front_page = [new_blog] + [blog for blog in front_page if blog.id != new_blog.id]
 
-		else:
-			front_page = db.GqlQuery('SELECT * FROM Blog ORDER BY created DESC LIMIT 10')
-			front_cache = cls.get_seconds()
-			memcache.set('front_page', front_page)
-			memcache.set('front_cache', front_cache)
+		return front_page[:FRONT_PAGE_SIZE], time.time()
 
-		cache_age = cls.cache_delta(front_cache)
 
-		return front_page, cache_age
+	# Write-through on publish: the new post is pushed onto the cached front page
+	# and the oldest trimmed, with compare-and-set so concurrent publishes don't
+	# drop each other. If the page isn't cached, or the updates keep conflicting,
+	# it is rematerialized instead.
+	@classmethod
+	def push_front_page(cls, new_blog):
+		client = memcache.Client()
+
+		for i in xrange(FRONT_PAGE_RETRIES):
+			front = blogrecords.decode_front_page(blogcache.get(FRONT_PAGES, 'home', client))
+			if not front:
+				break
+
+			front_page = [new_blog] + [blog for blog in front[0] if blog.id != new_blog.id]
+			data = blogrecords.encode_front_page(front_page[:FRONT_PAGE_SIZE], time.time())
+			if blogcache.set(FRONT_PAGES, 'home', data, 'cas', client):
+				return
+
+		front_page, materialized = cls.materialize_front_page(new_blog)
+		blogcache.set(FRONT_PAGES, 'home', blogrecords.encode_front_page(front_page, materialized))
+
+
+	# Archive pages are walked with datastore cursors, so any page costs one
+	# fetch of ARCHIVE_PAGE_SIZE posts no matter how deep it is. A cursor marks
+	# the position after a given post, and new posts only ever go before the
+	# first one, so every page but the head (no cursor) is fixed once written
+	# and stays cached; Blog.create only marks the head stale.
+	#
+	# Returns (blogs, next_cursor, cache_age), or None for a cursor that isn't valid.
+	@classmethod
+	def archive_page(cls, cursor=None):
+		page = blogcache.get_or_load(ARCHIVE_PAGES, cursor or '_head', lambda: cls.load_archive_page(cursor),
+									 blogrecords.decode_archive_page)
+
+		if not page:
+			return None
+
+		blogs, next_cursor, cached = page
+		return blogs, next_cursor, int(time.time() - cached)
+
+
+	@classmethod
+	def load_archive_page(cls, cursor):
+		query = Blog.all().order('-created')
+		try:
+			if cursor:
+				query.with_cursor(cursor)
+			blogs = [blogrecords.blog_record(blog) for blog in query.fetch(ARCHIVE_PAGE_SIZE)]
+		except (db.BadValueError, db.BadRequestError):
+			return None
+
+		next_cursor = query.cursor() if len(blogs) == ARCHIVE_PAGE_SIZE else None
+		return blogrecords.encode_archive_page(blogs, next_cursor, time.time())
 
 
 	@classmethod
 	def get_blog(cls, blog_id):
-		blog = memcache.get(BLOG_PREFIX + blog_id)
+		return blogcache.get_or_load(POSTS, blog_id, lambda: cls.load_blog(blog_id), blogrecords.decode_blog)
 
-		if blog:
-			blog.cache_age = cls.cache_delta(blog.last_cached)
-		else:
-			blog = Blog.get_by_id(int(blog_id))
 
-			if blog:
-				blog.last_cached = cls.get_seconds()
-				blog.cache_age = cls.cache_delta(blog.last_cached)
-				memcache.set(BLOG_PREFIX + blog_id, blog)
+	# Resolves all the ids with one memcache get_multi, one batched datastore
+	# get for the misses and one set_multi to cache them. Returns BlogRecords in
+	# the order asked for, leaving out ids with no post.
+	@classmethod
+	def get_blogs(cls, blog_ids):
+		if not blog_ids:
+			return []
+
+		cached = blogcache.get_multi(POSTS, blog_ids)
+		blogs = dict((blog_id, blogrecords.decode_blog(data)) for blog_id, data in cached.iteritems())
+		missing = [blog_id for blog_id in blog_ids if not blogs.get(blog_id)]
+
+		if missing:
+			loaded = {}
+			for blog_id, entity in zip(missing, Blog.get_by_id([int(blog_id) for blog_id in missing])):
+				if entity:
+					blogs[blog_id] = blogrecords.blog_record(entity)
+					loaded[blog_id] = blogrecords.encode_blog(blogs[blog_id])
+
+			blogcache.set_multi(POSTS, loaded)
+
+		return [blogs[blog_id] for blog_id in blog_ids if blogs.get(blog_id)]
+
+
+	# A post's rendered markup is the same on every page that lists it, so it is
+	# cached by post id and list pages only join the fragments. All of them are
+	# read with one get_multi; render(blog) makes the missing ones, which are
+	# stored with one set_multi. Returns the fragments in the order of blogs.
+	@classmethod
+	def get_fragments(cls, blogs, render):
+		keys = [cls.fragment_key(blog.id) for blog in blogs]
+		fragments = blogcache.get_multi(FRAGMENTS, keys)
+
+		rendered = {}
+		for key, blog in zip(keys, blogs):
+			if key not in fragments:
+				fragments[key] = rendered[key] = render(blog)
+
+		if rendered:
+			blogcache.set_multi(FRAGMENTS, rendered)
+
+		return [fragments[key] for key in keys]
+
+
+	@classmethod
+	def fragment_key(cls, blog_id):
+		return '%d:%s' % (FRAGMENT_FORMAT, blog_id)
+
+
+	# The feed is built from the cached front page records, never from a query,
+	# and cached serialized as (etag, last modified, xml) where last modified is
+	# the newest post's time in seconds. Blog.create marks it stale right after
+	# updating the front page, so the next reader rebuilds it single-flight.
+	@classmethod
+	def get_feed(cls):
+		return blogcache.get_or_load(FEEDS, 'atom', cls.load_feed)
+
+
+	@classmethod
+	def load_feed(cls):
+		front_page = cls.most_recents()[0]
+		updated = front_page[0].created if front_page else datetime(1970, 1, 1)
+
+		xml = blogutils.renderAtom(front_page, app_identity.get_default_version_hostname(), updated)
+		return hashlib.sha1(xml).hexdigest(), calendar.timegm(updated.utctimetuple()), xml
+
 
-		return blog
+	@classmethod
+	def load_blog(cls, blog_id):
+		entity = Blog.get_by_id(int(blog_id))
+		return blogrecords.encode_blog(blogrecords.blog_record(entity)) if entity else None
 
 
 
@@ -160,15 +456,94 @@ class Blog(db.Model):
 			return None
 
 		blog = Blog(subject = subject, content = content, author = user_author)
-		blog.last_cached = cls.get_seconds()
 
 		blog.put()
 		blog_id = str(blog.key().id())
 
-		memcache.set(BLOG_PREFIX + blog_id, blog)
-		memcache.delete('front_page')
+		record = blogrecords.blog_record(blog)
+		blogcache.set(POSTS, blog_id, blogrecords.encode_blog(record))
+		cls.push_front_page(record)
+		blogcache.invalidate(ARCHIVE_PAGES, '_head')
+		blogcache.invalidate(FEEDS, 'atom')
+
+		if user_author:
+			AuthorIndex.add_post(user_author, blog.key().id(), blog.created)
 
 		return blog_id
 
 
 
+# class AuthorIndex(db.Model)
+# One shard of an author's post index, keyed by normalized author name and
+# shard number. A post goes to the shard picked by its id, so an author's
+# posts are spread over AUTHOR_INDEX_SHARDS entities and no single one takes
+# every write for a prolific author. created holds each post's creation time
+# (microseconds, see blogrecords.encode_time), so reading the index is one
+# batch get of all the shards merged newest first, and the author's post
+# count is just its length.
+
+class AuthorIndex(db.Model):
+	post_ids = db.ListProperty(int, indexed=False)
+	created = db.ListProperty(int, indexed=False)
+
+
+	@classmethod
+	def shard_keys(cls, author):
+		return [cls.shard_key(author, i) for i in xrange(AUTHOR_INDEX_SHARDS)]
+
+
+	@classmethod
+	def shard_key(cls, author, shard):
+		return db.Key.from_path('AuthorIndex', 'a:%s:%d' % (author.lower(), shard))
+
+
+	@classmethod
+	def get_post_ids(cls, author):
+		return blogcache.get_or_load(AUTHORS, author.lower(), lambda: cls.load_post_ids(author))
+
+
+	@classmethod
+	def load_post_ids(cls, author):
+		posts = []
+		for shard in db.get(cls.shard_keys(author)):
+			if shard:
+				posts.extend(zip(shard.created, shard.post_ids))
+
+		return [post_id for created, post_id in sorted(posts, reverse=True)]
+
+
+	@classmethod
+	def add_post(cls, author, blog_id, created):
+		key = cls.shard_key(author, blog_id % AUTHOR_INDEX_SHARDS)
+		db.run_in_transaction(cls.insert_post, key, blog_id, blogrecords.encode_time(created))
+		blogcache.invalidate(AUTHORS, author.lower())
+
+
+	@classmethod
+	def insert_post(cls, key, blog_id, created):
+		shard = AuthorIndex.get(key) or AuthorIndex(key=key)
+
+		if blog_id not in shard.post_ids:
+			shard.post_ids.append(blog_id)
+			shard.created.append(created)
+			shard.put()
+
+
+# index_authors()
+# One-time backfill of the author indexes from the posts written before they
+# existed. Adds one batch of posts and defers itself for the next batch.
+# Adding a post that's already indexed does nothing, so it can run alongside
+# new posts.
+
+def index_authors(cursor=None):
+	query = Blog.all()
+	if cursor:
+		query.with_cursor(cursor)
+
+	blogs = query.fetch(MIGRATION_BATCH_SIZE)
+	for blog in blogs:
+		if blog.author:
+			AuthorIndex.add_post(blog.author, blog.key().id(), blog.created)
+
+	if len(blogs) == MIGRATION_BATCH_SIZE:
+		deferred.defer(index_authors, query.cursor())
@@ -0,0 +1,129 @@
+import os
+import time
+import hmac
+import hashlib
+import threading
+
+
+# Password hashing for User records.
+#
+# Passwords are stored as "<algorithm>$<cost>$<salt>$<hash>" by a pluggable
+# hasher (PBKDF2-SHA256 by default). Passwords stored before that are a bare
+# MD5 of the 5 letter salt plus password; those still verify, and check_password
+# reports that they need rehashing so User.check_pass can upgrade them on the
+# user's next login. The same goes for hashes made with an older cost.
+#
+# A KDF costs real CPU, so at most MAX_CONCURRENT_HASHES hashes run at once per
+# instance. Requests beyond that wait up to HASH_WAIT_TIMEOUT seconds for a
+# slot and then get HasherBusy, so a burst of logins can't starve the threads
+# serving pages. (App Engine doesn't let threads outlive a request, so the
+# "pool" is a set of slots the request threads take turns on rather than
+# long-lived worker threads.)
+#
+# Run this module directly to pick PBKDF2_ITERATIONS for a target latency.
+
+PBKDF2_ITERATIONS = 20000
+SALT_BYTES = 16
+
+MAX_CONCURRENT_HASHES = 2
+HASH_WAIT_TIMEOUT = 2.0
+
+_slots = threading.BoundedSemaphore(MAX_CONCURRENT_HASHES)
+
+
+class HasherBusy(Exception):
+	pass
+
+
+class PBKDF2Hasher(object):
+	algorithm = 'pbkdf2_sha256'
+
+	def __init__(self, iterations=PBKDF2_ITERATIONS):
+		self.iterations = iterations
+
+	def encode(self, password, salt=None, iterations=None):
+		salt = salt or os.urandom(SALT_BYTES).encode('hex')
+		iterations = iterations or self.iterations
+		digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations).encode('hex')
+		return '%s$%d$%s$%s' % (self.algorithm, iterations, salt, digest)
+
+	def verify(self, password, encoded):
+		encoded = str(encoded)
+		algorithm, iterations, salt, digest = encoded.split('$', 3)
+		return hmac.compare_digest(self.encode(password, salt, int(iterations)), encoded)
+
+	def needs_rehash(self, encoded):
+		algorithm, iterations = str(encoded).split('$', 2)[:2]
+		return algorithm != self.algorithm or int(iterations) != self.iterations
+
+
+class LegacyMD5Hasher(object):
+	algorithm = 'md5'
+
+	def verify(self, password, encoded, salt):
+		return hmac.compare_digest(hashlib.md5((salt + password).encode('utf-8')).hexdigest(), str(encoded))
+
+
+HASHERS = {PBKDF2Hasher.algorithm: PBKDF2Hasher()}
+DEFAULT_HASHER = HASHERS[PBKDF2Hasher.algorithm]
+LEGACY_HASHER = LegacyMD5Hasher()
+
+
+def run_bounded(function, *args):
+	deadline = time.time() + HASH_WAIT_TIMEOUT
+
+	while not _slots.acquire(False):
+		if time.time() > deadline:
+			raise HasherBusy()
+		time.sleep(0.01)
+
+	try:
+		return function(*args)
+	finally:
+		_slots.release()
+
+
+def make_password(password):
+	return run_bounded(DEFAULT_HASHER.encode, password)
+
+
+# Returns (matches, needs_rehash). legacy_salt is the User's salt property,
+# only used for passwords stored before hashers existed.
+
+def check_password(password, encoded, legacy_salt=None):
+	if not password or not encoded:
+		return False, False
+
+	if '$' not in encoded:
+		matches = run_bounded(LEGACY_HASHER.verify, password, encoded, legacy_salt or '')
+		return matches, matches
+
+	hasher = HASHERS.get(encoded.split('$', 1)[0])
+	if not hasher:
+		return False, False
+
+	matches = run_bounded(hasher.verify, password, encoded)
+	return matches, matches and DEFAULT_HASHER.needs_rehash(encoded)
+
+
+# Doubles the PBKDF2 cost until one hash takes at least target_ms on this
+# machine and returns that iteration count.
+
+def calibrate(target_ms=100.0, start=1000):
+	iterations = start
+	while True:
+		hasher = PBKDF2Hasher(iterations)
+		started = time.time()
+		hasher.encode('calibration password')
+		elapsed_ms = (time.time() - started) * 1000
+
+		print '%8d iterations: %7.1f ms' % (iterations, elapsed_ms)
+		if elapsed_ms >= target_ms:
+			return iterations
+		iterations *= 2
+
+
+if __name__ == '__main__':
+	import sys
+	target = float(sys.argv[1]) if len(sys.argv) > 1 else 100.0
+	print 'PBKDF2_ITERATIONS = %d  # for ~%d ms per hash' % (calibrate(target), target)
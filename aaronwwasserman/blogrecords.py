@@ -0,0 +1,146 @@
+import json
+import time
+import marshal
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from google.appengine.ext import db
+
+
+# Compact records for what the blog keeps in memcache.
+#
+# Instead of pickling whole db.Model instances, the cache holds marshalled
+# tuples of just the fields the handlers use, tagged with a format number and
+# record type. Decoding gives back read-only namedtuples; anything that doesn't
+# decode (an older format, or an entity pickled before records existed) reads
+# as a cache miss.
+
+RECORD_FORMAT = 4
+EPOCH = datetime(1970, 1, 1)
+
+
+class UserRecord(namedtuple('UserRecord', 'uid username salt password')):
+	__slots__ = ()
+
+	def key(self):
+		return db.Key.from_path('User', 'u:' + self.username.lower())
+
+
+# last_cached is the time.time() the record was cached at. json is the post's
+# JSON object, serialized once when the record is made and cached along with it,
+# so JSON responses are written by joining these fragments.
+
+class BlogRecord(namedtuple('BlogRecord', 'id subject content author created last_cached json')):
+	__slots__ = ()
+
+	def key(self):
+		return db.Key.from_path('Blog', self.id)
+
+	@property
+	def cache_age(self):
+		return int(time.time() - self.last_cached)
+
+
+def encode_time(dt):
+	if dt is None:
+		return None
+	delta = dt - EPOCH
+	return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def decode_time(us):
+	if us is None:
+		return None
+	return EPOCH + timedelta(microseconds=us)
+
+
+def user_record(user):
+	uid = user.uid if user.uid is not None else user.key().id()
+	return UserRecord(uid, user.username, user.salt, user.password)
+
+
+def post_json(blog, blog_id):
+	return json.dumps({'id' : blog_id, 'subject' : blog.subject, 'content' : blog.content, 'author' : blog.author,
+					   'created' : blog.created.strftime('%b %d, %Y - %I:%M %p')})
+
+
+def blog_record(blog, last_cached=None):
+	blog_id = blog.key().id()
+	return BlogRecord(blog_id, blog.subject, unicode(blog.content), blog.author, blog.created,
+					  last_cached if last_cached is not None else time.time(), post_json(blog, blog_id))
+
+
+def dumps(tag, row):
+	return marshal.dumps((RECORD_FORMAT, tag, row))
+
+
+def loads(tag, data):
+	if not isinstance(data, str):
+		return None
+
+	try:
+		record_format, record_tag, row = marshal.loads(data)
+	except (ValueError, EOFError, TypeError):
+		return None
+
+	if record_format != RECORD_FORMAT or record_tag != tag:
+		return None
+
+	return row
+
+
+def encode_user(user):
+	return dumps('U', tuple(user))
+
+
+def decode_user(data):
+	row = loads('U', data)
+	return UserRecord(*row) if row else None
+
+
+def blog_row(blog):
+	return (blog.id, blog.subject, blog.content, blog.author, encode_time(blog.created), blog.last_cached, blog.json)
+
+
+def row_blog(row):
+	blog_id, subject, content, author, created, last_cached, post = row
+	return BlogRecord(blog_id, subject, content, author, decode_time(created), last_cached, post)
+
+
+def encode_blog(blog):
+	return dumps('B', blog_row(blog))
+
+
+def decode_blog(data):
+	row = loads('B', data)
+	return row_blog(row) if row else None
+
+
+# The front page is stored as the time it was materialized plus its records.
+
+def encode_front_page(blogs, materialized):
+	return dumps('F', (materialized, [blog_row(blog) for blog in blogs]))
+
+
+def decode_front_page(data):
+	row = loads('F', data)
+	if not row:
+		return None
+	materialized, rows = row
+	return [row_blog(r) for r in rows], materialized
+
+
+# An archive page is stored with the time it was cached and the cursor of the
+# page after it (None on the last page).
+
+def encode_archive_page(blogs, next_cursor, cached):
+	return dumps('A', (cached, next_cursor, [blog_row(blog) for blog in blogs]))
+
+
+def decode_archive_page(data):
+	row = loads('A', data)
+	if not row:
+		return None
+	cached, next_cursor, rows = row
+	return [row_blog(r) for r in rows], next_cursor, cached
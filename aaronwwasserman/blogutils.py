@@ -1,5 +1,11 @@
 import re
 import json
+import hmac
+import time
+import hashlib
+
+from collections import namedtuple
+from xml.sax.saxutils import escape
 
 
 # class regexChecking()
@@ -30,20 +36,99 @@ class regexChecking():
 		return EMAIL_RE.match(email)
 
 
+# Session tokens
+# A session is carried entirely in the user_id cookie as
+#   username|uid|expires|signature
+# where signature is an HMAC-SHA256 of the rest under the app's secret, so a
+# request's identity is checked without any storage lookup.
+#
+# read_session_token returns a Session for a valid, unexpired token, else None.
 
+SESSION_LIFETIME = 30 * 24 * 3600
 
+Session = namedtuple('Session', 'username uid expires')
+
+def sign(value, secret):
+	return hmac.new(secret, value, hashlib.sha256).hexdigest()
+
+def make_session_token(username, uid, secret, now=None):
+	expires = int(now or time.time()) + SESSION_LIFETIME
+	value = '%s|%d|%d' % (username, uid, expires)
+	return '%s|%s' % (value, sign(value, secret))
+
+def read_session_token(token, secret, now=None):
+	if not token:
+		return None
+
+	try:
+		parts = str(token).split('|')
+	except UnicodeError:
+		return None
+
+	if len(parts) != 4 or not parts[1].isdigit() or not parts[2].isdigit():
+		return None
+
+	username, uid, expires, signature = parts
+	if not hmac.compare_digest(sign('|'.join(parts[:3]), secret), signature):
+		return None
+	if int(expires) < (now or time.time()):
+		return None
+
+	return Session(username, int(uid), int(expires))
 
-# renderJSON()
-# Takes in a list of blogs and outputs the corresponding list in proper JSON.
 
-def renderJSON(blog_list):
-	result = []
 
-	for blog in blog_list:
-		blog_dict = {'subject' : blog.subject, 'content' : blog.content, 'author' : blog.author,
-                     'created' : blog.created.strftime('%b %d, %Y - %I:%M %p')}
-		result.append(blog_dict)
-	
-	return json.dumps(result)
 
 
+
+# writeJSON()
+# Writes a list of blogs to out as a JSON list, piece by piece from each blog's
+# pre-serialized fragment, so the response is never built as one string.
+# writeJSONPage() does the same for an archive page, along with the cursor
+# of the next page.
+
+def writeJSON(out, blog_list):
+	out.write('[')
+	for i, blog in enumerate(blog_list):
+		if i:
+			out.write(',')
+		out.write(blog.json)
+	out.write(']')
+
+def writeJSONPage(out, blog_list, next_cursor):
+	out.write('{"posts":')
+	writeJSON(out, blog_list)
+	out.write(',"next":%s}' % json.dumps(next_cursor))
+
+
+# renderAtom()
+# Takes in a list of blogs (newest first) and outputs them as an Atom feed.
+# Entry ids are tag URIs, so they stay the same if the blog changes hosts.
+
+ATOM_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+def renderAtom(blog_list, host, updated):
+	base = 'http://%s/' % host
+	parts = ['<?xml version="1.0" encoding="utf-8"?>\n',
+			 '<feed xmlns="http://www.w3.org/2005/Atom">\n',
+			 '<title>Aaron\'s Blog</title>\n',
+			 '<id>tag:%s,2013:blog</id>\n' % escape(host),
+			 '<link rel="alternate" href="%s"/>\n' % escape(base),
+			 '<link rel="self" href="%satom.xml"/>\n' % escape(base),
+			 '<updated>%s</updated>\n' % updated.strftime(ATOM_TIME_FORMAT)]
+
+	for blog in blog_list:
+		created = blog.created.strftime(ATOM_TIME_FORMAT)
+		parts.append('<entry>\n'
+					 '<title>%s</title>\n'
+					 '<id>tag:%s,2013:post-%d</id>\n'
+					 '<link rel="alternate" href="%s%d"/>\n'
+					 '<author><name>%s</name></author>\n'
+					 '<published>%s</published>\n'
+					 '<updated>%s</updated>\n'
+					 '<content type="text">%s</content>\n'
+					 '</entry>\n' % (escape(blog.subject), escape(host), blog.id, escape(base), blog.id,
+									  escape(blog.author or ''), created, created, escape(blog.content)))
+
+	parts.append('</feed>\n')
+	return u''.join(parts).encode('utf-8')
@@ -1,15 +1,21 @@
 import logging
+import calendar
+import email.utils
 import webapp2
-import os
-import jinja2
+import json
+import blogbytecode
+import blogcache
 import blogmodels
+import blogpasswords
 import blogutils
 
 from google.appengine.api import memcache
+from google.appengine.ext import deferred
 
-template_dir = os.path.join(os.path.dirname(__file__), 'templates')
-jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir),
-                               autoescape=True)
+jinja_env = blogbytecode.make_environment(memcache)
+blogbytecode.preload(jinja_env)
+
+BUSY_ERROR = 'Too many sign ins right now. Please try again in a moment.'
 
 
 class Handler(webapp2.RequestHandler):
@@ -25,31 +31,27 @@ class Handler(webapp2.RequestHandler):
     def render(self, template, **kw):
         self.write(self.render_str(template, **kw))
 
+    # The markup for a list of posts, joined from the cached per-post fragments.
+    def render_posts(self, blogs):
+        return u''.join(blogmodels.Blog.get_fragments(blogs, self.render_post))
+
+    def render_post(self, blog):
+        return self.render_str('blog_post.html', blog=blog)
+
     def fetch(self, url_parameter):
         return self.request.get(url_parameter)
 
-    def parse_cookie(self, user_cookie):
-        username = user_cookie.split('|')[0]
-        uid = user_cookie.split('|')[1]
-        return username, uid
-
     def check_secure_cookie(self):
         user_cookie = self.request.cookies.get('user_id')
-        #cookie_secure = True
 
         if user_cookie:
-            username, uid = self.parse_cookie(user_cookie)
-            user = blogmodels.User.get_user(username)
-            if user:
-                if int(uid) == user.key().id():
-                    return user
+            return blogutils.read_session_token(user_cookie, blogmodels.Secret.get_secret())
         else:
             return None
 
     def make_secure_cookie(self, user):
-        username = str(user.username)
-        uid = str(user.key().id())
-        self.response.headers.add_header('Set-Cookie', 'user_id=%s|%s; Path=/' % (username, uid))
+        token = blogutils.make_session_token(str(user.username), user.uid, blogmodels.Secret.get_secret())
+        self.response.headers.add_header('Set-Cookie', 'user_id=%s; Path=/' % token)
 
     def get_user_inputs(self, case=''):
         if case == 'signup' or case == 'login':
@@ -84,7 +86,7 @@ class Handler(webapp2.RequestHandler):
             if not re_check.username(username):
                 errors['username_error'] = 'Invalid username.'
                 errors_exist = True
-            elif blogmodels.User.get_user(username):
+            elif blogmodels.User.name_taken(username):
                 errors['username_error'] = 'Username already exists.'
                 errors_exist = True
             if not re_check.password(password):
@@ -102,8 +104,12 @@ class Handler(webapp2.RequestHandler):
             password = inputs.get('password')
             user = blogmodels.User.get_user(username)
 
-            if not user or not user.check_pass(user, password):
-                errors['login_error'] = 'Invalid credentials. Please try again.'
+            try:
+                if not user or not blogmodels.User.check_pass(user, password):
+                    errors['login_error'] = 'Invalid credentials. Please try again.'
+                    errors_exist = True
+            except blogpasswords.HasherBusy:
+                errors['login_error'] = BUSY_ERROR
                 errors_exist = True
 
         elif case == 'newpost':
@@ -118,9 +124,8 @@ class Handler(webapp2.RequestHandler):
 
     def initialize(self, *a, **kw):
         webapp2.RequestHandler.initialize(self, *a, **kw)
-        global logged_in_user
-        logged_in_user = self.check_secure_cookie()
-        if logged_in_user:
+        self.logged_in_user = self.check_secure_cookie()
+        if self.logged_in_user:
             logging.error('Logged in!')
         else:
             logging.error('Not logged in!')
@@ -128,18 +133,15 @@ class Handler(webapp2.RequestHandler):
 
 class MainPage(Handler):
     def get(self, blog_id=None, json=False):
-        global logged_in_user
-
         if blog_id:
             blog = blogmodels.Blog.get_blog(blog_id)
 
             if blog: # Blog passed in URL was valid
                 if json:
                     self.response.headers['Content-Type'] = 'application/json; charset=UTF-8'
-                    blog_json = blogutils.renderJSON([blog])
-                    self.write(blog_json)
+                    blogutils.writeJSON(self.response.out, [blog])
                 else:
-                    self.render('blog_home.html', front_page=[blog], cache_age=blog.cache_age, user = logged_in_user)
+                    self.render('blog_home.html', posts=self.render_posts([blog]), cache_age=blog.cache_age, user = self.logged_in_user)
 
             else: # Blog passed in URL was not valid (or no longer found within the db)
                 self.redirect('/')
@@ -148,10 +150,95 @@ class MainPage(Handler):
             front_page, cache_age = blogmodels.Blog.most_recents()
             if json:
                 self.response.headers['Content-Type'] = 'application/json; charset=UTF-8'
-                front_json = blogutils.renderJSON(front_page)
-                self.write(front_json)
+                blogutils.writeJSON(self.response.out, front_page)
             else:
-                self.render('blog_home.html', front_page=front_page, cache_age=cache_age, user = logged_in_user)
+                self.render('blog_home.html', posts=self.render_posts(front_page), cache_age=cache_age, user = self.logged_in_user)
+
+
+# The Atom feed. Pollers that send back the ETag or Last-Modified they were
+# given get a 304 while nothing new has been posted.
+class AtomFeed(Handler):
+    def get(self):
+        etag, updated, xml = blogmodels.Blog.get_feed()
+        self.response.etag = etag
+        self.response.headers['Last-Modified'] = email.utils.formatdate(updated, usegmt=True)
+
+        if self.not_modified(etag, updated):
+            self.response.set_status(304)
+            return
+
+        self.response.headers['Content-Type'] = 'application/atom+xml; charset=UTF-8'
+        self.write(xml)
+
+    def not_modified(self, etag, updated):
+        if self.request.if_none_match:
+            return etag in self.request.if_none_match
+
+        since = self.request.if_modified_since
+        return since is not None and calendar.timegm(since.utctimetuple()) >= updated
+
+
+# One author's posts, newest first, AUTHOR_PAGE_SIZE at a time (?p= for older
+# ones), served from the author's post index and a batched post fetch.
+class AuthorPage(Handler):
+    def get(self, username, json=False):
+        p = self.fetch('p')
+        page = int(p) if p.isdigit() else 0
+        start = page * blogmodels.AUTHOR_PAGE_SIZE
+
+        post_ids = blogmodels.AuthorIndex.get_post_ids(username)
+        blogs = blogmodels.Blog.get_blogs([str(post_id) for post_id in
+                                           post_ids[start:start + blogmodels.AUTHOR_PAGE_SIZE]])
+        count = len(post_ids)
+        more = count > start + blogmodels.AUTHOR_PAGE_SIZE
+
+        if json:
+            self.response.headers['Content-Type'] = 'application/json; charset=UTF-8'
+            # username is limited to [a-zA-Z0-9_-] by the route, so needs no escaping
+            self.write('{"author":"%s","count":%d,"posts":' % (username, count))
+            blogutils.writeJSON(self.response.out, blogs)
+            self.write(',"next":%s}' % (page + 1 if more else 'null'))
+        else:
+            next_url = '/author/%s?p=%d' % (username, page + 1) if more else None
+            self.render('blog_home.html', posts=self.render_posts(blogs), author=username, count=count, next_url=next_url,
+                        json_url='/author/%s/json' % username, user = self.logged_in_user)
+
+
+# Many posts by id at once, e.g. /posts/json?ids=1,2,3, resolved in one batch.
+# Ids that aren't numbers or have no post are left out.
+class PostsJSON(Handler):
+    def get(self):
+        blog_ids = []
+        for blog_id in self.fetch('ids').split(','):
+            blog_id = blog_id.strip()
+            if blog_id.isdigit() and blog_id not in blog_ids:
+                blog_ids.append(blog_id)
+
+        blogs = blogmodels.Blog.get_blogs(blog_ids[:blogmodels.MAX_BATCH_POSTS])
+
+        self.response.headers['Content-Type'] = 'application/json; charset=UTF-8'
+        blogutils.writeJSON(self.response.out, blogs)
+
+
+# Older posts, a page at a time. The page's cursor is part of the URL; a
+# cursor that doesn't decode goes back to the first page.
+class ArchivePage(Handler):
+    def get(self, cursor=None, json=False):
+        page = blogmodels.Blog.archive_page(cursor)
+
+        if not page:
+            self.redirect('/page')
+            return
+
+        blogs, next_cursor, cache_age = page
+        if json:
+            self.response.headers['Content-Type'] = 'application/json; charset=UTF-8'
+            blogutils.writeJSONPage(self.response.out, blogs, next_cursor)
+        else:
+            json_url = '/page/%s/json' % cursor if cursor else '/page/json'
+            next_url = '/page/%s' % next_cursor if next_cursor else None
+            self.render('blog_home.html', posts=self.render_posts(blogs), cache_age=cache_age, next_url=next_url,
+                        json_url=json_url, user = self.logged_in_user)
 
 
 class Signup(Handler):
@@ -163,13 +250,37 @@ class Signup(Handler):
         errors = self.get_input_errors(inputs, 'signup')
 
         if not errors:
-            new_user = blogmodels.User.create(inputs)
+            try:
+                new_user = blogmodels.User.create(inputs)
+            except blogpasswords.HasherBusy:
+                inputs['password_error'] = BUSY_ERROR
+                self.render('blog_signup.html', **inputs)
+                return
+
+            if not new_user:
+                # taken between the check above and the transaction
+                inputs['username_error'] = 'Username already exists.'
+                self.render('blog_signup.html', **inputs)
+                return
+
             self.make_secure_cookie(new_user)
             self.redirect('/welcome/')
         else:
             self.render('blog_signup.html', **errors)
 
 
+# Tells the signup form whether a username is free while it's being typed.
+class SignupCheck(Handler):
+    def get(self):
+        username = self.fetch('username')
+        valid = bool(blogutils.regexChecking().username(username))
+        available = valid and not blogmodels.User.name_taken(username)
+
+        self.response.headers['Content-Type'] = 'application/json; charset=UTF-8'
+        self.response.headers['Cache-Control'] = 'no-cache'
+        self.write(json.dumps({'username': username, 'valid': valid, 'available': available}))
+
+
 class Login(Handler):
     def get(self):
         self.render('blog_login.html')
@@ -194,32 +305,27 @@ class Logout(Handler):
 
 class Welcome(Handler):
     def get(self):
-        global logged_in_user
-        if logged_in_user:
-            self.render('blog_welcome.html', username=logged_in_user.username)
+        if self.logged_in_user:
+            self.render('blog_welcome.html', username=self.logged_in_user.username)
         else:
             self.redirect('/login')
 
 
 class NewPost(Handler):
     def get(self):
-        global logged_in_user
-
-        if logged_in_user:
-            self.render('blog_newpost.html', username = logged_in_user.username)
+        if self.logged_in_user:
+            self.render('blog_newpost.html', username = self.logged_in_user.username)
         else:
             self.redirect('/login')
 
 
     def post(self):
-        global logged_in_user
-
-        if logged_in_user:
+        if self.logged_in_user:
             inputs = self.get_user_inputs('newpost')
             errors = self.get_input_errors(inputs, 'newpost')
 
             if not errors:
-                new_blog_id = blogmodels.Blog.create(inputs, logged_in_user.username)
+                new_blog_id = blogmodels.Blog.create(inputs, self.logged_in_user.username)
                 self.redirect('/%s' % new_blog_id)
             else:
                 self.render('blog_newpost.html', **errors)
@@ -227,6 +333,30 @@ class NewPost(Handler):
             self.redirect('/login')
 
 
+# Cache hit rates and latency per namespace, plus memcache's own totals.
+# Admin only (see app.yaml).
+class CacheStats(Handler):
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json; charset=UTF-8'
+        self.write(json.dumps({'namespaces': blogcache.get_stats(), 'memcache': memcache.get_stats()}))
+
+
+# Starts the one-time backfill of author indexes from existing posts.
+# Admin only (see app.yaml); the batches run on the task queue.
+class IndexAuthors(Handler):
+    def get(self):
+        deferred.defer(blogmodels.index_authors)
+        self.write('Author indexing started.')
+
+
+# Starts the one-time re-keying of users onto their normalized usernames.
+# Admin only (see app.yaml); the batches run on the task queue.
+class MigrateUsers(Handler):
+    def get(self):
+        deferred.defer(blogmodels.migrate_user_keys)
+        self.write('User migration started.')
+
+
 class Flush(Handler):
     def get(self, blog_id=None):
         if blog_id:
@@ -239,10 +369,18 @@ class Flush(Handler):
 
 app = webapp2.WSGIApplication([
                                   ('/(\d+)?(/?json)?/?', MainPage),
+                                  (r'/page(?:/(?!json/?$)([\w=-]+))?(/json)?/?', ArchivePage),
+                                  ('/atom\.xml', AtomFeed),
+                                  ('/posts/json/?', PostsJSON),
+                                  ('/author/([a-zA-Z0-9_-]+)(/json)?/?', AuthorPage),
+                                  ('/signup/check/?', SignupCheck),
                                   ('/signup/?', Signup),
                                   ('/login/?', Login),
                                   ('/logout/?', Logout),
                                   ('/welcome/?', Welcome),
                                   ('/newpost/?', NewPost),
+                                  ('/_admin/migrate_users/?', MigrateUsers),
+                                  ('/_admin/cache/?', CacheStats),
+                                  ('/_admin/index_authors/?', IndexAuthors),
                                   ('/?(\d+)?(?:/flush)/?', Flush)
                               ], debug=True)
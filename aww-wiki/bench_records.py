@@ -0,0 +1,56 @@
+# Compares the cached size and decode cost of pickled db.Model instances with
+# the compact records in records.py, per cache hit.
+#
+# Run with the App Engine SDK on the path:
+#   PYTHONPATH=$GAE_SDK python bench_records.py
+
+import cPickle
+import timeit
+
+from datetime import datetime
+
+import models
+import passwords
+import records
+import revisions
+
+
+def sample_history(versions=50):
+    history = []
+    content = u'<p>Some wiki content.</p>\n' * 40
+
+    for version in xrange(1, versions + 1):
+        new_content = content + u'<p>edit %d</p>\n' % version
+        wiki = models.Wiki(path=u'/sample', author=u'aaron', version=version, created=datetime.utcnow())
+        if revisions.is_keyframe(version):
+            wiki.content = new_content
+        else:
+            wiki.delta = revisions.make_delta(content, new_content)
+        history.append(wiki)
+        content = new_content
+
+    return history
+
+
+def report(name, pickled, encoded, decode_pickled, decode_encoded, number=2000):
+    pickled_time = timeit.timeit(decode_pickled, number=number) / number * 1e6
+    encoded_time = timeit.timeit(decode_encoded, number=number) / number * 1e6
+
+    print '%-8s pickled: %7d bytes %8.1f us/hit' % (name, len(pickled), pickled_time)
+    print '%-8s record:  %7d bytes %8.1f us/hit' % (name, len(encoded), encoded_time)
+    print '%-8s saved:   %7d bytes (%.0f%%)' % (name, len(pickled) - len(encoded),
+                                               100.0 * (len(pickled) - len(encoded)) / len(pickled))
+
+
+if __name__ == '__main__':
+    user = models.User(username=u'aaron', password=passwords.make_password(u'secret'))
+    user_pickled = cPickle.dumps(user, cPickle.HIGHEST_PROTOCOL)
+    user_encoded = records.encode_user(records.UserRecord(1, user.username, user.salt, user.password))
+    report('user', user_pickled, user_encoded,
+           lambda: cPickle.loads(user_pickled), lambda: records.decode_user(user_encoded))
+
+    history = sample_history()
+    history_pickled = cPickle.dumps(history, cPickle.HIGHEST_PROTOCOL)
+    history_encoded = records.encode_wikis([records.wiki_record(wiki) for wiki in history])
+    report('history', history_pickled, history_encoded,
+           lambda: cPickle.loads(history_pickled), lambda: records.decode_wikis(history_encoded), number=200)
@@ -0,0 +1,277 @@
+import base64
+import json
+import sys
+
+from datetime import datetime
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+import cache
+import linkgraph
+import models
+import records
+import revisions
+import usernames
+
+
+# Bulk export/import of the wiki as JSON Lines.
+#
+# export writes every Wiki revision (and optionally every User) one line at a
+# time, in key order, straight from a batched query iterator, so memory stays
+# constant however many revisions there are. Revisions are written as stored:
+# keyframes carry their content, the others their delta (base64).
+#
+# import reads the same lines and writes them with large batched puts. Every
+# revision is keyed by (path, version) under its page head. Pages the app
+# already has are checked first: the file may only add versions after the
+# app's head, with every earlier revision matching the app's, or the page is
+# skipped, so importing the same file twice changes nothing. Once all lines are
+# in, each imported page gets its head and history cache rebuilt, and its
+# search postings and links updated on the app's task queue. The file is read
+# more than once, so it must be seekable.
+#
+# Meant to be run against the live app through remote_api, e.g.
+#   python bulk.py export wiki.jsonl --host=aww-wiki.appspot.com --users
+#   python bulk.py import wiki.jsonl --host=aww-wiki.appspot.com
+
+BATCH_SIZE = 500
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def format_time(dt):
+    return dt.strftime(TIME_FORMAT) if dt else None
+
+
+def parse_time(value):
+    return datetime.strptime(value, TIME_FORMAT) if value else None
+
+
+def export_lines(include_users=False):
+    if include_users:
+        for user in models.User.all().order('__key__').run(batch_size=BATCH_SIZE):
+            uid = user.uid if user.uid is not None else user.key().id()
+            yield {'kind': 'User', 'id': uid, 'username': user.username, 'salt': user.salt,
+                   'password': user.password, 'email': user.email, 'created': format_time(user.created)}
+
+    for wiki in models.Wiki.all().order('__key__').run(batch_size=BATCH_SIZE):
+        yield {'kind': 'Wiki', 'path': wiki.path, 'version': wiki.version, 'author': wiki.author,
+               'created': format_time(wiki.created), 'length': wiki.length, 'preview': wiki.preview,
+               'content': wiki.content, 'delta': base64.b64encode(wiki.delta) if wiki.delta is not None else None}
+
+
+def export_wiki(out, include_users=False):
+    count = 0
+    for line in export_lines(include_users):
+        out.write(json.dumps(line, separators=(',', ':')))
+        out.write('\n')
+        count += 1
+
+    return count
+
+
+def user_entity(line):
+    user = models.User(key=models.User.key_for(line['username']), username=line['username'],
+                       uid=line['id'], salt=line['salt'], password=line['password'])
+    if line.get('email'):
+        user.email = line['email']
+    user.created = parse_time(line['created'])
+    return user
+
+
+def wiki_entity(line):
+    path, version = line['path'], line['version']
+    wiki = models.Wiki(parent=db.Key.from_path('WikiHead', path), key_name=str(version),
+                       path=path, author=line['author'], version=version,
+                       length=line.get('length'), preview=line.get('preview'))
+
+    if line.get('delta') is not None:
+        wiki.delta = db.Blob(base64.b64decode(line['delta']))
+    else:
+        wiki.content = line['content']
+
+    if wiki.length is None and wiki.content is not None:
+        # revisions exported before summaries existed are all full keyframes
+        wiki.length = len(wiki.content)
+        wiki.preview = revisions.make_preview(wiki.content)
+
+    wiki.created = parse_time(line['created'])
+    return wiki
+
+
+def read_lines(lines):
+    lines.seek(0)
+    for raw in lines:
+        if raw.strip():
+            yield json.loads(raw)
+
+
+def import_wiki(lines):
+    latest_versions = {}
+    for line in read_lines(lines):
+        if line['kind'] == 'Wiki':
+            latest_versions[line['path']] = max(latest_versions.get(line['path'], 0), line['version'])
+
+    head_versions, refused = check_pages(lines, latest_versions)
+
+    batch = []
+    max_user_id = 0
+    count = 0
+
+    for line in read_lines(lines):
+        if line['kind'] == 'User':
+            batch.append(user_entity(line))
+            max_user_id = max(max_user_id, line['id'])
+        elif line['path'] not in refused and line['version'] > head_versions.get(line['path'], 0):
+            batch.append(wiki_entity(line))
+
+        if len(batch) >= BATCH_SIZE:
+            db.put(batch)
+            count += len(batch)
+            batch = []
+
+    if batch:
+        db.put(batch)
+        count += len(batch)
+
+    if max_user_id:
+        # keep the id allocator from handing out imported uids again
+        db.allocate_id_range(db.Key.from_path('User', 1), 1, max_user_id)
+        usernames.reset_filter()
+
+    for path, version in latest_versions.iteritems():
+        if path not in refused:
+            restore_page(path, version)
+
+    return count
+
+
+# Finds the pages the app already has, before anything is written. Returns
+# ({path: head version} for those, set of refused paths). A page is refused if
+# the app has later versions than the file, or if any of its revisions up to
+# the app's head is missing or differs from the file's: later revisions are
+# deltas against the app's own, so writing the file's over them (or after
+# them) would corrupt the history. Revisions that match are left as they are.
+
+def check_pages(lines, latest_versions):
+    paths = sorted(latest_versions)
+    head_versions = {}
+    for i in xrange(0, len(paths), BATCH_SIZE):
+        for head in models.WikiHead.get_by_key_name(paths[i:i + BATCH_SIZE]):
+            if head:
+                head_versions[head.path] = head.version
+
+    refused = set()
+    for path, version in head_versions.iteritems():
+        if version > latest_versions[path]:
+            sys.stderr.write('skipped %s: the app is at version %d, the file only goes up to %d\n'
+                             % (path, version, latest_versions[path]))
+            refused.add(path)
+
+    if len(refused) == len(head_versions):
+        return head_versions, refused
+
+    batch = []
+    for line in read_lines(lines):
+        path = line.get('path')
+        if path in head_versions and path not in refused and line['version'] <= head_versions[path]:
+            batch.append(wiki_entity(line))
+
+        if len(batch) >= BATCH_SIZE:
+            refused.update(conflicting_pages(batch, refused))
+            batch = []
+
+    refused.update(conflicting_pages(batch, refused))
+    return head_versions, refused
+
+
+def conflicting_pages(wikis, refused):
+    conflicts = set()
+    if not wikis:
+        return conflicts
+
+    for wiki, existing in zip(wikis, db.get([wiki.key() for wiki in wikis])):
+        if wiki.path in refused or wiki.path in conflicts:
+            continue
+
+        if not existing or existing.content != wiki.content or existing.delta != wiki.delta:
+            sys.stderr.write('skipped %s: version %d differs from the app\'s\n' % (wiki.path, wiki.version))
+            conflicts.add(wiki.path)
+
+    return conflicts
+
+
+# Rebuilds a page's head and history cache from its revisions and queues the
+# update of its search postings and links. Revisions are fetched by key rather
+# than by query, so this sees everything the import just wrote. Returns False
+# for a page with missing versions, or one that already has later versions
+# than the file: its head is kept, since rolling it back would have the next
+# edit overwrite revisions.
+
+def restore_page(path, latest_version):
+    head_key = db.Key.from_path('WikiHead', path)
+    keys = [db.Key.from_path('Wiki', str(version), parent=head_key) for version in xrange(1, latest_version + 1)]
+
+    history = []
+    for i in xrange(0, len(keys), BATCH_SIZE):
+        history.extend(records.wiki_record(wiki) for wiki in db.get(keys[i:i + BATCH_SIZE]) if wiki)
+
+    if len(history) != latest_version:
+        sys.stderr.write('skipped %s: %d of %d versions found\n' % (path, len(history), latest_version))
+        return False
+
+    latest = history[-1]
+    content = models.Wiki.rebuild(history, len(history) - 1)
+
+    head = models.WikiHead(key_name=path, path=path, content=content, author=latest.author,
+                           version=latest.version, created=latest.created,
+                           links=sorted(linkgraph.extract_links(content)))
+    previous = db.run_in_transaction(replace_head, head)
+
+    if previous and previous.version > latest.version:
+        sys.stderr.write('kept %s at version %d: the file only goes up to %d\n' % (path, previous.version,
+                                                                                   latest.version))
+        cache.invalidate(models.HISTORIES, path)
+        return False
+
+    cache.set(models.HISTORIES, path, records.encode_wikis(history))
+    cache.set(models.HEADS, path, records.encode_wiki(records.wiki_record(head)))
+    # queued like an edit's, rather than a transaction per term over remote_api
+    deferred.defer(models.index_edit, path, latest.version, previous.content if previous else None, content)
+
+    return True
+
+
+# Puts head unless the page already has a later version. Returns the head that
+# was there before.
+
+def replace_head(head):
+    previous = models.WikiHead.get(head.key())
+
+    if not previous or previous.version <= head.version:
+        head.put()
+
+    return previous
+
+
+if __name__ == '__main__':
+    import optparse
+    from google.appengine.ext.remote_api import remote_api_stub
+
+    parser = optparse.OptionParser(usage='%prog export|import FILE --host=HOST [--users]')
+    parser.add_option('--host', help='app host, e.g. aww-wiki.appspot.com')
+    parser.add_option('--users', action='store_true', default=False, help='also export User records')
+    options, args = parser.parse_args()
+
+    if len(args) != 2 or args[0] not in ('export', 'import') or not options.host:
+        parser.error('expected export|import FILE and --host')
+
+    remote_api_stub.ConfigureRemoteApiForOAuth(options.host, '/_ah/remote_api')
+
+    if args[0] == 'export':
+        with open(args[1], 'w') as out:
+            total = export_wiki(out, options.users)
+    else:
+        with open(args[1]) as lines:
+            total = import_wiki(lines)
+
+    sys.stderr.write('%sed %d records\n' % (args[0], total))
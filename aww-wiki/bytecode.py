@@ -0,0 +1,101 @@
+import os
+import sys
+import time
+import jinja2
+
+
+# Jinja2 bytecode cache for templates.
+#
+# Compiled templates are looked up first in BYTECODE_DIR, which the build step
+# fills before a deploy, then in memcache, where an instance that did have to
+# compile a template leaves it for the others (App Engine's file system is read
+# only). Buckets carry a checksum of the template source, so a template edited
+# after the build is only a miss and never serves old code. Cache keys use the
+# template name alone, since the build and the app see different absolute paths.
+#
+# The build step compiles every template and fails on the first one with an
+# error, reporting the compile time of each:
+#   python bytecode.py
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+BYTECODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'template_cache')
+BYTECODE_PATTERN = '%s.cache'
+MEMCACHE_PREFIX = 'aw_wiki_jinja-'
+TEMPLATE_EXTENSIONS = ['html']
+
+
+class BytecodeCache(jinja2.FileSystemBytecodeCache):
+    def __init__(self, client=None, directory=BYTECODE_DIR):
+        jinja2.FileSystemBytecodeCache.__init__(self, directory, BYTECODE_PATTERN)
+        self.client = client
+
+    def get_cache_key(self, name, filename=None):
+        return jinja2.FileSystemBytecodeCache.get_cache_key(self, name)
+
+    def load_bytecode(self, bucket):
+        jinja2.FileSystemBytecodeCache.load_bytecode(self, bucket)
+
+        if bucket.code is None and self.client:
+            data = self.client.get(MEMCACHE_PREFIX + bucket.key)
+            if data is not None:
+                bucket.bytecode_from_string(data)
+
+    def dump_bytecode(self, bucket):
+        if self.client:
+            self.client.set(MEMCACHE_PREFIX + bucket.key, bucket.bytecode_to_string())
+        else:
+            jinja2.FileSystemBytecodeCache.dump_bytecode(self, bucket)
+
+
+# Builds the app's template environment. client is the memcache module or a
+# memcache.Client; without one, compiled templates are written to BYTECODE_DIR.
+
+def make_environment(client=None):
+    return jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATE_DIR), extensions=['jinja2.ext.autoescape'],
+                              bytecode_cache=BytecodeCache(client))
+
+
+def template_names(env):
+    return env.list_templates(extensions=TEMPLATE_EXTENSIONS)
+
+
+# Loads every template into the environment, so the first request to use one
+# doesn't pay for it.
+
+def preload(env):
+    for name in template_names(env):
+        env.get_template(name)
+
+
+# Compiles every template into BYTECODE_DIR. Returns [(name, ms, error)].
+
+def precompile():
+    if not os.path.isdir(BYTECODE_DIR):
+        os.makedirs(BYTECODE_DIR)
+
+    env = make_environment()
+    env.bytecode_cache.clear()
+
+    results = []
+    for name in template_names(env):
+        started = time.time()
+        try:
+            env.get_template(name)
+            error = None
+        except jinja2.TemplateError, e:
+            error = e
+        results.append((name, (time.time() - started) * 1000, error))
+
+    return results
+
+
+if __name__ == '__main__':
+    failed = False
+    for name, ms, error in precompile():
+        if error:
+            failed = True
+            print '%-30s FAILED: %s (line %s)' % (name, error, getattr(error, 'lineno', '?'))
+        else:
+            print '%-30s %7.1f ms' % (name, ms)
+
+    sys.exit(1 if failed else 0)
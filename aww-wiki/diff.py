@@ -0,0 +1,185 @@
+import re
+
+
+# Line and word level diffs between two versions of a wiki page.
+#
+# Uses Myers' O(ND) algorithm in its linear space form: instead of keeping
+# every furthest-reaching path, it walks forward and backward at once until the
+# two meet on a "middle snake", splits the problem there and recurses, so only
+# two vectors of size N+M are kept per level.
+#
+# Large inputs are cut off cleanly rather than run unbounded: each side is
+# limited to MAX_LINES lines, and a sub-problem needing more than MAX_COST
+# edits is reported as a plain delete + insert instead of being searched.
+
+MAX_LINES = 5000
+MAX_COST = 1000
+MAX_WORDS = 2000
+
+WORD_RE = re.compile(r'\s+|\w+|[^\w\s]', re.UNICODE)
+
+EQUAL = '='
+DELETE = '-'
+INSERT = '+'
+
+
+def diff_sequences(a, b, max_cost=MAX_COST):
+    ops = []
+    _diff(a, b, ops, max_cost)
+    return merge(ops)
+
+
+def _diff(a, b, ops, max_cost):
+    prefix = 0
+    while prefix < len(a) and prefix < len(b) and a[prefix] == b[prefix]:
+        prefix += 1
+
+    suffix = 0
+    while (suffix < len(a) - prefix and suffix < len(b) - prefix and
+           a[len(a) - 1 - suffix] == b[len(b) - 1 - suffix]):
+        suffix += 1
+
+    if prefix:
+        ops.append((EQUAL, a[:prefix]))
+
+    middle_a = a[prefix:len(a) - suffix]
+    middle_b = b[prefix:len(b) - suffix]
+
+    if not middle_a:
+        if middle_b:
+            ops.append((INSERT, middle_b))
+    elif not middle_b:
+        ops.append((DELETE, middle_a))
+    else:
+        split = middle_snake(middle_a, middle_b, max_cost)
+        if split is None:
+            ops.append((DELETE, middle_a))
+            ops.append((INSERT, middle_b))
+        else:
+            x, y = split
+            _diff(middle_a[:x], middle_b[:y], ops, max_cost)
+            _diff(middle_a[x:], middle_b[y:], ops, max_cost)
+
+    if suffix:
+        ops.append((EQUAL, a[len(a) - suffix:]))
+
+
+# Finds the point where the forward and backward furthest-reaching paths
+# overlap and returns it as (x, y), or None if that takes more than max_cost
+# edits.
+
+def middle_snake(a, b, max_cost):
+    n, m = len(a), len(b)
+    max_d = (n + m + 1) // 2
+    offset = max_d
+    size = 2 * max_d + 2
+
+    forward = [-1] * size
+    backward = [-1] * size
+    forward[offset + 1] = 0
+    backward[offset + 1] = 0
+
+    delta = n - m
+    odd = delta % 2 != 0
+
+    # diagonals that ran off the grid are trimmed from the next round
+    k1_start = k1_end = k2_start = k2_end = 0
+
+    for d in xrange(min(max_d, max_cost)):
+        for k1 in xrange(-d + k1_start, d + 1 - k1_end, 2):
+            k1_offset = offset + k1
+            if k1 == -d or (k1 != d and forward[k1_offset - 1] < forward[k1_offset + 1]):
+                x1 = forward[k1_offset + 1]
+            else:
+                x1 = forward[k1_offset - 1] + 1
+            y1 = x1 - k1
+
+            while x1 < n and y1 < m and a[x1] == b[y1]:
+                x1 += 1
+                y1 += 1
+            forward[k1_offset] = x1
+
+            if x1 > n:
+                k1_end += 2
+            elif y1 > m:
+                k1_start += 2
+            elif odd:
+                k2_offset = offset + delta - k1
+                if 0 <= k2_offset < size and backward[k2_offset] != -1:
+                    if x1 >= n - backward[k2_offset]:
+                        return x1, y1
+
+        for k2 in xrange(-d + k2_start, d + 1 - k2_end, 2):
+            k2_offset = offset + k2
+            if k2 == -d or (k2 != d and backward[k2_offset - 1] < backward[k2_offset + 1]):
+                x2 = backward[k2_offset + 1]
+            else:
+                x2 = backward[k2_offset - 1] + 1
+            y2 = x2 - k2
+
+            while x2 < n and y2 < m and a[n - x2 - 1] == b[m - y2 - 1]:
+                x2 += 1
+                y2 += 1
+            backward[k2_offset] = x2
+
+            if x2 > n:
+                k2_end += 2
+            elif y2 > m:
+                k2_start += 2
+            elif not odd:
+                k1_offset = offset + delta - k2
+                if 0 <= k1_offset < size and forward[k1_offset] != -1:
+                    x1 = forward[k1_offset]
+                    y1 = x1 - (k1_offset - offset)
+                    if x1 >= n - x2:
+                        return x1, y1
+
+    return None
+
+
+def merge(ops):
+    merged = []
+    for op, items in ops:
+        if merged and merged[-1][0] == op:
+            merged[-1] = (op, merged[-1][1] + items)
+        else:
+            merged.append((op, items))
+    return merged
+
+
+# Returns (blocks, truncated). Each block is (op, text) for a run of unchanged,
+# removed or added lines, or ('~', parts) for a changed region, where parts are
+# (op, text) word level edits across the region's old and new lines.
+
+def diff_pages(old, new):
+    old_lines = old.splitlines(True)
+    new_lines = new.splitlines(True)
+
+    truncated = len(old_lines) > MAX_LINES or len(new_lines) > MAX_LINES
+    ops = diff_sequences(old_lines[:MAX_LINES], new_lines[:MAX_LINES])
+
+    blocks = []
+    i = 0
+    while i < len(ops):
+        op, lines = ops[i]
+        if op != EQUAL and i + 1 < len(ops) and ops[i + 1][0] not in (EQUAL, op):
+            removed, added = (lines, ops[i + 1][1]) if op == DELETE else (ops[i + 1][1], lines)
+            parts = diff_words(''.join(removed), ''.join(added))
+            if parts is not None:
+                blocks.append(('~', parts))
+                i += 2
+                continue
+        blocks.append((op, ''.join(lines)))
+        i += 1
+
+    return blocks, truncated
+
+
+def diff_words(old, new):
+    old_words = WORD_RE.findall(old)
+    new_words = WORD_RE.findall(new)
+
+    if len(old_words) > MAX_WORDS or len(new_words) > MAX_WORDS:
+        return None
+
+    return [(op, ''.join(words)) for op, words in diff_sequences(old_words, new_words)]
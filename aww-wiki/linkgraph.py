@@ -0,0 +1,39 @@
+import re
+
+
+# Helpers for the wiki's link graph.
+#
+# Pulls the internal links out of a page's html: href values that are
+# absolute wiki paths (the same shape as main.PAGE_RE), minus the reserved
+# routes. The forward and reverse indexes themselves are kept by
+# models.WikiHead.links and models.WikiLinks.
+
+HREF_RE = re.compile(r'''href\s*=\s*["']?([^"'\s>]+)''', re.IGNORECASE)
+PATH_RE = re.compile(r'^/(?:[a-zA-Z0-9_-]+/?)*$')
+
+RESERVED = ('/login', '/logout', '/signup', '/flush')
+
+
+def is_page(path):
+    if not PATH_RE.match(path) or path.startswith('/_'):
+        return False
+    return not any(path == r or path.startswith(r + '/') for r in RESERVED)
+
+
+def extract_links(content):
+    if not content:
+        return set()
+
+    found = set()
+    for href in HREF_RE.findall(content):
+        path = href.split('#')[0].split('?')[0]
+        if is_page(path):
+            found.add(path)
+
+    return found
+
+
+def changed_links(old_content, new_content):
+    old_links = extract_links(old_content)
+    new_links = extract_links(new_content)
+    return new_links - old_links, old_links - new_links
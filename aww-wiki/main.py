@@ -1,13 +1,20 @@
 import webapp2
-import os
-import jinja2
+import hashlib
+import json
+import urllib
+import bytecode
+import cache
 import utilities
 import models
+import passwords
 
 from google.appengine.api import memcache
+from google.appengine.ext import deferred
 
-template_dir = os.path.join(os.path.dirname(__file__), 'templates')
-jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir), extensions=['jinja2.ext.autoescape'])
+jinja_env = bytecode.make_environment(memcache)
+bytecode.preload(jinja_env)
+
+BUSY_ERROR = 'Too many sign ins right now. Please try again in a moment.'
 
 
 class Handler(webapp2.RequestHandler):
@@ -26,27 +33,17 @@ class Handler(webapp2.RequestHandler):
     def fetch(self, url_parameter):
         return self.request.get(url_parameter)
 
-    def parse_cookie(self, user_cookie):
-        username = user_cookie.split('|')[0]
-        uid = user_cookie.split('|')[1]
-        return username, uid
-
     def check_secure_cookie(self):
         user_cookie = self.request.cookies.get('user_id')
 
         if user_cookie:
-            username, uid = self.parse_cookie(user_cookie)
-            user = models.User.get_user(username)
-            if user:
-                if int(uid) == user.key().id():
-                    return user
+            return utilities.read_session_token(user_cookie, models.Secret.get_secret())
         else:
             return None
 
     def make_secure_cookie(self, user):
-        username = str(user.username)
-        uid = str(user.key().id())
-        self.response.headers.add_header('Set-Cookie', 'user_id=%s|%s; Path=/' % (username, uid))
+        token = utilities.make_session_token(str(user.username), user.uid, models.Secret.get_secret())
+        self.response.headers.add_header('Set-Cookie', 'user_id=%s; Path=/' % token)
 
     def get_user_inputs(self, case=''):
         if case == 'signup' or case == 'login':
@@ -79,7 +76,7 @@ class Handler(webapp2.RequestHandler):
             if not re_check.username(username):
                 errors['username_error'] = 'Invalid username.'
                 errors_exist = True
-            elif models.User.get_user(username):
+            elif models.User.name_taken(username):
                 errors['username_error'] = 'Username already exists.'
                 errors_exist = True
             if not re_check.password(password):
@@ -97,8 +94,12 @@ class Handler(webapp2.RequestHandler):
             password = inputs.get('password')
             user = models.User.get_user(username)
 
-            if not user or not user.check_pass(user, password):
-                errors['login_error'] = 'Invalid credentials. Please try again.'
+            try:
+                if not user or not models.User.check_pass(user, password):
+                    errors['login_error'] = 'Invalid credentials. Please try again.'
+                    errors_exist = True
+            except passwords.HasherBusy:
+                errors['login_error'] = BUSY_ERROR
                 errors_exist = True
 
         elif case == 'edit':
@@ -112,9 +113,8 @@ class Handler(webapp2.RequestHandler):
 
     def initialize(self, *a, **kw):
         webapp2.RequestHandler.initialize(self, *a, **kw)
-        global logged_in_user
-        logged_in_user = self.check_secure_cookie()
-        # if logged_in_user:
+        self.logged_in_user = self.check_secure_cookie()
+        # if self.logged_in_user:
         #     logging.error('Logged in!')
         # else:
         #     logging.error('Not logged in!')
@@ -129,13 +129,39 @@ class Signup(Handler):
         errors = self.get_input_errors(inputs, 'signup')
 
         if not errors:
-            new_user = models.User.create(inputs)
+            try:
+                new_user = models.User.create(inputs)
+            except passwords.HasherBusy:
+                inputs['password_error'] = BUSY_ERROR
+                self.render('wiki_signup.html', **inputs)
+                return
+
+            if not new_user:
+                # taken between the check above and the transaction
+                inputs['username_error'] = 'Username already exists.'
+                self.render('wiki_signup.html', **inputs)
+                return
+
             self.make_secure_cookie(new_user)
             self.redirect('/')
         else:
             self.render('wiki_signup.html', **errors)
 
 
+# class SignupCheck(Handler)
+# Tells the signup form whether a username is free while it's being typed.
+
+class SignupCheck(Handler):
+    def get(self):
+        username = self.fetch('username')
+        valid = bool(utilities.regexChecking().username(username))
+        available = valid and not models.User.name_taken(username)
+
+        self.response.headers['Content-Type'] = 'application/json; charset=UTF-8'
+        self.response.headers['Cache-Control'] = 'no-cache'
+        self.write(json.dumps({'username': username, 'valid': valid, 'available': available}))
+
+
 class Login(Handler):
     def get(self):
         self.render('wiki_login.html')
@@ -160,61 +186,191 @@ class Logout(Handler):
 
 class EditPage(Handler):
     def get(self, path):
-        global logged_in_user
         v = self.fetch('v')
 
         wiki = models.Wiki.get_wiki(path, v)
 
-        if logged_in_user:
+        if self.logged_in_user:
             if wiki:
-                self.render('wiki_edit.html', username=logged_in_user.username, path=path,
+                self.render('wiki_edit.html', username=self.logged_in_user.username, path=path,
                             content=wiki.content, version=wiki.version)
             else:
-                self.render('wiki_edit.html', username=logged_in_user.username, path=path, version="1")
+                self.render('wiki_edit.html', username=self.logged_in_user.username, path=path, version="1")
         else:
             self.redirect('/logout/')
 
     def post(self, path):
-        global logged_in_user
-
-        if not logged_in_user:
+        if not self.logged_in_user:
             self.redirect('/login/')
         else:
             inputs = self.get_user_inputs('edit')
             errors = self.get_input_errors(inputs, 'edit')
 
             if errors:
-                self.render('wiki_edit.html', username=logged_in_user.username,
+                self.render('wiki_edit.html', username=self.logged_in_user.username,
                             path=path, post_error=errors.get('post_error'))
             else:
                 inputs['path'] = path
-                inputs['author'] = logged_in_user.username
+                inputs['author'] = self.logged_in_user.username
 
                 new_wiki = models.Wiki.create(inputs)
-                self.redirect(new_wiki.path)
+
+                if new_wiki:
+                    self.redirect(new_wiki.path)
+                else:
+                    self.render('wiki_edit.html', username=self.logged_in_user.username, path=path,
+                                content=inputs.get('content'),
+                                post_error='Someone else saved this page at the same time. Please try again.')
 
 
 class History(Handler):
     def get(self, path):
-        global logged_in_user
-        wiki_history = models.Wiki.wiki_history(path)
-        wiki_history.reverse()
-        self.render('wiki_history.html', user=logged_in_user, path=path, history=wiki_history)
+        cursor = self.fetch('c')
+        wiki_history, next_cursor = models.Wiki.history_page(path, cursor)
+        self.render('wiki_history.html', user=self.logged_in_user, path=path, history=wiki_history,
+                    cursor=cursor, next_cursor=next_cursor)
+
+
+class Diff(Handler):
+    def get(self, path):
+        head = models.Wiki.get_head(path)
+
+        if not head:
+            self.redirect(path)
+            return
+
+        to_param = self.fetch('to')
+        from_param = self.fetch('from')
+        to_version = int(to_param) if to_param.isdigit() else head.version
+        from_version = int(from_param) if from_param.isdigit() else to_version - 1
+
+        if not (1 <= from_version <= head.version and 1 <= to_version <= head.version):
+            self.redirect('/_history' + path)
+            return
+
+        blocks, truncated = models.Wiki.get_diff(path, from_version, to_version)
+        self.render('wiki_diff.html', user=self.logged_in_user, path=path, blocks=blocks, truncated=truncated,
+                    from_version=from_version, to_version=to_version)
+
+
+class Backlinks(Handler):
+    def get(self, path):
+        backlinks = models.WikiLinks.get_backlinks(path)
+        self.render('wiki_links.html', user=self.logged_in_user, path=path, backlinks=backlinks)
+
+
+class LinkReport(Handler):
+    def get(self):
+        orphans, dead_links = models.WikiLinks.report()
+        self.render('wiki_links.html', user=self.logged_in_user, path='/', report=True,
+                    orphans=orphans, dead_links=dead_links)
+
+
+class HistoryJSON(Handler):
+    def get(self, path):
+        wiki_history, next_cursor = models.Wiki.history_page(path, self.fetch('c'))
+
+        for wiki in wiki_history:
+            wiki['created'] = wiki['created'].strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        self.response.headers['Content-Type'] = 'application/json; charset=UTF-8'
+        self.write(json.dumps({'path': path, 'history': wiki_history, 'next': next_cursor}))
+
 
+# class WikiPage(Handler)
+# Serves a version of a wiki page.
+
+# A (path, version) never changes once written, so its rendered page is cached
+# per variant (anonymous, or per logged in user since the page shows the username)
+# and served with a strong ETag. A request for an explicit version whose ETag the
+# client already holds gets a 304 without any lookup at all.
 
 class WikiPage(Handler):
     def get(self, path):
-        global logged_in_user
         v = self.fetch('v')
+        version = int(v) if v.isdigit() else None
+        variant = 'user:' + self.logged_in_user.username if self.logged_in_user else 'anon'
 
-        wiki = models.Wiki.get_wiki(path, v)
+        if version and self.not_modified(path, version, variant):
+            return
 
-        if wiki:
-            self.render('wiki_home.html', user=logged_in_user, path=path, content=str(wiki.content))
-        elif logged_in_user:
-            self.redirect('/_edit' + path)
-        else:
-            self.redirect('/login/')
+        head = models.Wiki.get_head(path)
+
+        if not head:
+            if self.logged_in_user:
+                self.redirect('/_edit' + path)
+            else:
+                self.redirect('/login/')
+            return
+
+        if not version or version > head.version:
+            version = head.version
+
+        if self.not_modified(path, version, variant):
+            return
+
+        key = '%s:%d:%s' % (variant, version, path)
+        html = cache.get_or_load(models.PAGES, key, lambda: self.render_page(path, version))
+
+        self.write(html)
+
+    # get_wiki falls back to the head while the history is catching up; that
+    # page is neither cached nor tagged as the version asked for.
+    def render_page(self, path, version):
+        wiki = models.Wiki.get_wiki(path, version)
+        html = self.render_str('wiki_home.html', user=self.logged_in_user, path=path, content=wiki.content)
+
+        if wiki.version == version:
+            return html
+
+        self.response.etag = None
+        return cache.Uncacheable(html)
+
+    def not_modified(self, path, version, variant):
+        etag = hashlib.sha1('%s:%d:%s' % (variant, version, path)).hexdigest()
+        self.response.etag = etag
+        self.response.headers['Vary'] = 'Cookie'
+
+        if etag in self.request.if_none_match:
+            self.response.set_status(304)
+            return True
+
+        return False
+
+
+class Search(Handler):
+    def get(self):
+        query = self.fetch('q')
+        p = self.fetch('p')
+        page = int(p) if p.isdigit() else 0
+
+        results, more = models.SearchTerm.search(query, page)
+        self.render('wiki_search.html', user=self.logged_in_user, q=query, q_param=urllib.quote_plus(query.encode('utf-8')),
+                    page=page, results=results, more=more)
+
+
+# Cache hit rates and latency per namespace, plus memcache's own totals.
+# Admin only (see app.yaml).
+class CacheStats(Handler):
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json; charset=UTF-8'
+        self.write(json.dumps({'namespaces': cache.get_stats(), 'memcache': memcache.get_stats()}))
+
+
+# Starts the one-time re-keying of users onto their normalized usernames.
+# Admin only (see app.yaml); the batches run on the task queue.
+class MigrateUsers(Handler):
+    def get(self):
+        deferred.defer(models.migrate_user_keys)
+        self.write('User migration started.')
+
+
+# Starts the one-time backfill of the search and link indexes.
+# Admin only (see app.yaml); the batches run on the task queue.
+class IndexPages(Handler):
+    def get(self):
+        deferred.defer(models.index_pages)
+        self.write('Page indexing started.')
 
 
 class Flush(Handler):
@@ -224,11 +380,20 @@ class Flush(Handler):
 
 
 PAGE_RE = r'(/(?:[a-zA-Z0-9_-]+/?)*)'
-app = webapp2.WSGIApplication([('/signup/?', Signup),
+app = webapp2.WSGIApplication([('/signup/check/?', SignupCheck),
+                               ('/signup/?', Signup),
                                ('/login/?', Login),
                                ('/logout' + PAGE_RE, Logout),
                                ('/_edit' + PAGE_RE, EditPage),
+                               ('/_history.json' + PAGE_RE, HistoryJSON),
                                ('/_history' + PAGE_RE, History),
+                               ('/_diff' + PAGE_RE, Diff),
+                               ('/_backlinks' + PAGE_RE, Backlinks),
+                               ('/_links/?', LinkReport),
+                               ('/_search/?', Search),
+                               ('/_admin/migrate_users/?', MigrateUsers),
+                               ('/_admin/index_pages/?', IndexPages),
+                               ('/_admin/cache/?', CacheStats),
                                ('/flush/?', Flush),
                                (PAGE_RE, WikiPage)
                               ],
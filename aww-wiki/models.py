@@ -1,91 +1,306 @@
-# import logging
-import random
-import hashlib
-import string
+import logging
+import os
+import json
+import zlib
+import cache
+import diff
+import linkgraph
+import passwords
+import records
+import revisions
+import search
+import usernames
 
 from google.appengine.ext import db
+from google.appengine.ext import deferred
 from google.appengine.api import memcache
 
 
-# Used in memcache
-USERNAME_PREFIX = 'aw_wiki_user-'
-WIKI_PREFIX = 'aw_wiki_page-'
+# Used in memcache, see cache.py
+DAY = 24 * 3600
 
+USERS = cache.Namespace('user', ttl=DAY)
+NO_USERS = cache.Namespace('nouser', ttl=60)
+HISTORIES = cache.Namespace('history', ttl=7 * DAY, chunked=True)
+HEADS = cache.Namespace('head', ttl=7 * DAY)
+DIFFS = cache.Namespace('diff', ttl=DAY, chunked=True)
+PAGES = cache.Namespace('html', ttl=DAY)
+TERMS = cache.Namespace('term', ttl=DAY)
+BACKLINKS = cache.Namespace('links', ttl=DAY)
+LINK_REPORTS = cache.Namespace('linkreport', ttl=300, stale=DAY)
+
+HISTORY_PAGE_SIZE = 20
+SEARCH_PAGE_SIZE = 10
+MIGRATION_BATCH_SIZE = 100
+INDEX_BATCH_SIZE = 10 # pages per backfill task, each indexed term is a transaction
+MAX_POSTINGS_SIZE = 900 * 1000 # bytes, under the 1MB entity limit
+TERM_SHARDS = 16 # entities each term's postings are split over
+
+# Version allocation for an edit is retried this many times on contention
+EDIT_TRANSACTION = db.create_transaction_options(retries=3)
+# A backlink update reads the linking page's head as well as the target's entry,
+# a postings update the page's IndexedPage as well as the term's shard
+LINK_TRANSACTION = db.create_transaction_options(xg=True)
+INDEX_TRANSACTION = db.create_transaction_options(xg=True)
+
+
+
+# class Secret(db.Model)
+# Holds the key session tokens are signed with. Created with a random value the
+# first time it's needed and kept in memory per instance after that.
+
+class Secret(db.Model):
+    value = db.StringProperty(required=True)
+    _value = None
+
+
+    @classmethod
+    def get_secret(cls):
+        if not cls._value:
+            secret = Secret.get_or_insert('session', value=os.urandom(32).encode('hex'))
+            cls._value = str(secret.value)
+
+        return cls._value
 
 
 # class User(db.Model)
 # Defines the "User" object for the wiki.
 
-# All users will have a username, password, salt (for checking their hashed password),
-# and date created.  Email address is optional.
+# All users will have a username, password hash and date created.  Email address is optional.
+# salt is only set for users whose password predates the KDF hashers and is still MD5.
+
+# Users are keyed by their normalized (lowercased) username, so looking one up
+# or checking a name is free is a key get that can run in a transaction.
+# uid is a stable numeric id for session tokens: users keyed by id before this
+# kept their old id, new users get one allocated at signup.
 
 class User(db.Model):
     username = db.StringProperty(required=True)
-    salt = db.StringProperty(required=True)
+    uid = db.IntegerProperty()
+    salt = db.StringProperty()
     password = db.StringProperty()
     email = db.EmailProperty()
     created = db.DateTimeProperty(auto_now_add=True)
 
 
+    @classmethod
+    def normalize(cls, username):
+        return username.lower()
+
+
+    @classmethod
+    def key_for(cls, username):
+        return db.Key.from_path('User', 'u:' + cls.normalize(username))
+
+
     @classmethod
     def get_user(cls, username):
-        user = memcache.get(USERNAME_PREFIX + username)
+        user = records.decode_user(cache.get(USERS, cls.normalize(username)))
         if not user:
             # logging.error('--------------->MC MISS -- USER: %s' % username)
-            # logging.error('--------------->DB SRCH -- USER: %s' % username)
-            query = User.all()
-            query.filter("username =", username)
-            user = query.get()
-            if user:
-                memcache.set(USERNAME_PREFIX + user.username, user)
+            # logging.error('--------------->DB GET -- USER: %s' % username)
+            entity = User.get(cls.key_for(username)) or cls.get_legacy_user(username)
+            if entity:
+                user = records.user_record(entity)
+                cache.set(USERS, cls.normalize(user.username), records.encode_user(user))
                 # logging.error('--------------->MC ADD -- USER: %s' % user.username)
 
         return user
 
 
+    # Users stored before name keys, until migrate_user_keys has got to them.
+    # One found here is migrated on the spot.
     @classmethod
-    def hash_pass(cls, password, salt):
-        return hashlib.md5(salt + password).hexdigest()
+    def get_legacy_user(cls, username):
+        legacy = User.all().filter('username =', username).get()
+        if not legacy or legacy.key().name() is not None:
+            return legacy
+
+        return cls.migrate(legacy)
+
+
+    # Re-keys an id-keyed user by name. The name key is only created if it's
+    # free, in a transaction; if it already belongs to this user (same uid) the
+    # old entity is deleted, otherwise both are kept and it's logged, to be
+    # resolved by hand. Returns the user under the name key, or None.
+    @classmethod
+    def migrate(cls, legacy):
+        migrated = db.run_in_transaction(cls.insert_migrated, legacy)
+
+        if migrated.uid != legacy.key().id():
+            logging.warning('Not migrating user %s (id %d): %s already exists', legacy.username,
+                            legacy.key().id(), migrated.username)
+            return None
+
+        legacy.delete()
+        cls.cache_user(migrated)
+        return migrated
 
 
     @classmethod
-    def make_salt(cls):
-        return "".join(random.choice(string.letters) for x in xrange(5))
+    def insert_migrated(cls, legacy):
+        key = cls.key_for(legacy.username)
+        existing = User.get(key)
+        if existing:
+            return existing
+
+        migrated = User(key=key, username=legacy.username, uid=legacy.key().id(), salt=legacy.salt,
+                        password=legacy.password, email=legacy.email, created=legacy.created)
+        migrated.put()
+        return migrated
+
+
+    # Whether a username is taken, for signup checks. Most names asked about don't
+    # exist, so a miss is answered by the shared Bloom filter or a short-lived
+    # negative entry before it ever reaches the datastore.
+    @classmethod
+    def name_taken(cls, username):
+        name = cls.normalize(username)
+        if cache.get(NO_USERS, name):
+            return False
+
+        bloom = usernames.get_filter(cls.all_usernames)
+        if name not in bloom:
+            return False
+
+        if cls.get_user(username):
+            return True
+
+        cache.set(NO_USERS, name, True)
+        return False
+
+
+    # Projection on username rather than key names, so users not yet migrated
+    # to name keys are counted too.
+    @classmethod
+    def all_usernames(cls):
+        query = db.Query(User, projection=('username',))
+        return (cls.normalize(user.username) for user in query.run(batch_size=1000))
 
 
     @classmethod
     def insert(cls, user):
         user.put()
-        memcache.set(USERNAME_PREFIX + user.username, user)
+        cls.cache_user(user)
         # logging.error('--------------->DB PUT -- USER: %s' % user.username)
+
+
+    @classmethod
+    def cache_user(cls, user):
+        cache.set(USERS, cls.normalize(user.username), records.encode_user(records.user_record(user)))
         # logging.error('--------------->MC ADD -- USER: %s' % user.username)
 
 
+    # Returns None if the username was taken, checked in the same transaction
+    # as the put.
     @classmethod
     def create(cls, user_form):
-        user = User(username=user_form.get('username'), salt=cls.make_salt())
-        user.password = cls.hash_pass(user_form.get('password'), user.salt)
+        username = user_form.get('username')
+        user = User(key=cls.key_for(username), username=username)
+        user.password = passwords.make_password(user_form.get('password'))
         if user_form.get('email'):
             user.email = user_form.get('email')
 
-        cls.insert(user)
+        user.uid = db.allocate_ids(db.Key.from_path('User', 1), 1)[0]
 
+        if not db.run_in_transaction(cls.insert_new, user):
+            return None
+
+        cls.cache_user(user)
+        usernames.add_name(cls.normalize(username))
+        cache.delete(NO_USERS, cls.normalize(username))
         return user
 
 
+    @classmethod
+    def insert_new(cls, user):
+        if User.get(user.key()):
+            return False
+
+        user.put()
+        return True
+
+
+    # Passwords stored with MD5 or an outdated cost are rehashed on a successful login.
     @classmethod
     def check_pass(cls, user, password):
         if user and password:
-            return user.password == cls.hash_pass(password, user.salt)
+            matches, needs_rehash = passwords.check_password(password, user.password, user.salt)
+            if needs_rehash:
+                cls.upgrade_password(user, password)
+            return matches
         else:
             return False
 
 
-class Wiki(db.Model):
+    @classmethod
+    def upgrade_password(cls, user, password):
+        try:
+            password_hash = passwords.make_password(password)
+        except passwords.HasherBusy:
+            return # try again on the next login
+
+        entity = User.get(user.key())
+        entity.password = password_hash
+        entity.salt = None
+        cls.insert(entity)
+
+
+# migrate_user_keys()
+# One-time migration of users stored before they were keyed by username.
+# Re-keys one batch of id-keyed users (see User.migrate) and defers itself for
+# the next batch. Users are also migrated as they're looked up, so logins work
+# while this runs.
+
+def migrate_user_keys(cursor=None):
+    query = User.all()
+    if cursor:
+        query.with_cursor(cursor)
+
+    users = query.fetch(MIGRATION_BATCH_SIZE)
+    for user in users:
+        if user.key().name() is None:
+            User.migrate(user)
+
+    if len(users) == MIGRATION_BATCH_SIZE:
+        deferred.defer(migrate_user_keys, query.cursor())
+
+
+# class WikiHead(db.Model)
+# Defines the latest revision of a wiki page, keyed by the page path.
+
+# Holds the current version number and full content, so serving the latest
+# version of a page is a single key lookup no matter how long its history is.
+# links is the forward link index: the wiki paths the current version links to.
+# Kept up to date by Wiki.create.
+
+class WikiHead(db.Model):
     path = db.StringProperty(required=True)
     content = db.TextProperty(required=True)
     author = db.StringProperty(required=True)
     version = db.IntegerProperty(required=True)
+    created = db.DateTimeProperty()
+    links = db.StringListProperty(indexed=False)
+
+
+# class Wiki(db.Model)
+# Defines a single revision of a wiki page.
+
+# Keyframe revisions hold the full page in content, every other revision only
+# holds a forward delta against the previous version (see revisions.py).
+# Revisions written before deltas were introduced are all full keyframes.
+
+# length and preview describe the full content of the revision, so the history
+# view can list revisions without rebuilding any content.
+
+class Wiki(db.Model):
+    path = db.StringProperty(required=True)
+    content = db.TextProperty()
+    delta = db.BlobProperty()
+    length = db.IntegerProperty(indexed=False)
+    preview = db.StringProperty(indexed=False)
+    author = db.StringProperty(required=True)
+    version = db.IntegerProperty(required=True)
     created = db.DateTimeProperty(auto_now_add=True)
 
 
@@ -95,78 +310,567 @@ class Wiki(db.Model):
             path = wiki_inputs.get('path')
             content = wiki_inputs.get('content')
             author = wiki_inputs.get('author')
-            version = cls.num_versions(path) + 1
 
-            wiki = Wiki(path=path, content=content, author=author, version=version)
-            wiki.put()
+            cls.get_head(path) # make sure pages predating heads have one before allocating a version
+
+            try:
+                wiki, head, previous = db.run_in_transaction_options(EDIT_TRANSACTION, cls.commit,
+                                                                     path, content, author)
+            except db.TransactionFailedError:
+                # logging.error('--------------->DB CONFLICT -- WIKI: %s' % path)
+                return None
+
             # logging.error('--------------->DB PUT -- WIKI: %s' % wiki.path)
             cls.update_cache(path, wiki)
+            cls.cache_head(path, head)
+            deferred.defer(index_edit, path, wiki.version, previous, content)
+
+            wiki.content = content
             return wiki
 
         else:
             return None
 
 
+    # Runs inside a transaction on the page's entity group: the head is re-read
+    # there, so two concurrent edits can never be given the same version.
+    # Revisions are keyed by version under their head, which makes a duplicate
+    # version impossible even if the head were bypassed.
+    @classmethod
+    def commit(cls, path, content, author):
+        head_key = db.Key.from_path('WikiHead', path)
+        head = WikiHead.get(head_key)
+        version = head.version + 1 if head else 1
+        previous = head.content if head else None
+
+        wiki = Wiki(parent=head_key, key_name=str(version), path=path, author=author, version=version,
+                    length=len(content), preview=revisions.make_preview(content))
+        if revisions.is_keyframe(version):
+            wiki.content = content
+        else:
+            wiki.delta = db.Blob(revisions.make_delta(head.content, content))
+
+        head = WikiHead(key_name=path, path=path, content=content, author=author,
+                        version=version, created=wiki.created, links=sorted(linkgraph.extract_links(content)))
+
+        db.put([wiki, head])
+        return wiki, head, previous
+
+
     @classmethod
     def wiki_history(cls, path):
-        history = memcache.get(WIKI_PREFIX + '_history' + path)
+        return cache.get_or_load(HISTORIES, path, lambda: cls.load_history(path), records.decode_wikis)
 
-        if not history:
-            q = Wiki.all()
-            q.filter("path =", path)
-            # logging.error('--------------->MC MISS -- WIKI: %s' % path)
-            # logging.error('--------------->DB SRCH -- WIKI: %s' % path)
 
-            if q:
-                history = []
-                for wiki in q:
-                    history.append(wiki)
-                memcache.set(WIKI_PREFIX + '_history' + path, history)
-                # logging.error('--------------->MC ADD-- WIKI: %s' % path)
+    @classmethod
+    def load_history(cls, path):
+        q = Wiki.all()
+        q.filter("path =", path)
+        # logging.error('--------------->MC MISS -- WIKI: %s' % path)
+        # logging.error('--------------->DB SRCH -- WIKI: %s' % path)
 
-        if history:
-            history = sorted(history, key=lambda wiki: wiki.version)
+        history = [records.wiki_record(wiki) for wiki in sorted(q, key=lambda wiki: wiki.version)]
+        data = records.encode_wikis(history)
 
-        return history
+        # the path query is eventually consistent: only cache it once no version is missing
+        if history and history[-1].version == len(history):
+            return data
+        return cache.Uncacheable(data)
 
 
+    # Appends a new revision to the cached history with compare-and-set. If the
+    # cached list doesn't end with the previous version (a concurrent edit got
+    # there first, or it is stale) it is marked stale rather than left to
+    # diverge, and reloaded by the next reader.
     @classmethod
     def update_cache(cls, path, wiki):
-        history = cls.wiki_history(path)
+        client = memcache.Client()
+        history = records.decode_wikis(cache.get(HISTORIES, path, client))
+
+        if history is None:
+            return
+
+        last_version = history[-1].version if history else 0
+        if last_version == wiki.version - 1:
+            history.append(records.wiki_record(wiki))
+            if cache.set(HISTORIES, path, records.encode_wikis(history), 'cas', client):
+                return
+
+        cache.invalidate(HISTORIES, path)
 
-        if history:
-            history.append(wiki)
+
+    @classmethod
+    def cache_head(cls, path, head):
+        client = memcache.Client()
+        cached = records.decode_wiki(cache.get(HEADS, path, client))
+        data = records.encode_wiki(records.wiki_record(head))
+
+        if cached is None:
+            stored = cache.set(HEADS, path, data, 'add', client)
+        elif cached.version < head.version:
+            stored = cache.set(HEADS, path, data, 'cas', client)
         else:
-            history = [wiki]
+            stored = True
+
+        if not stored:
+            cache.invalidate(HEADS, path)
 
-        memcache.set(WIKI_PREFIX + '_history' + path, history) # update cache (path history -> list of wikis)
-        # logging.error('--------------->MC ADD-- WIKI: %s' % path)
+
+    @classmethod
+    def get_head(cls, path):
+        return cache.get_or_load(HEADS, path, lambda: cls.load_head(path), records.decode_wiki)
+
+
+    @classmethod
+    def load_head(cls, path):
+        head = WikiHead.get_by_key_name(path)
+
+        if not head:
+            # pages last edited before heads existed: build the head from their history
+            history = cls.wiki_history(path)
+
+            if history:
+                latest = history[-1]
+                head = WikiHead(key_name=path, path=path, content=cls.rebuild(history, len(history) - 1),
+                                author=latest.author, version=latest.version, created=latest.created)
+                head = db.run_in_transaction(cls.insert_head, head)
+
+        return records.encode_wiki(records.wiki_record(head)) if head else None
+
+
+    @classmethod
+    def insert_head(cls, head):
+        existing = WikiHead.get(head.key())
+        if existing:
+            return existing
+
+        head.put()
+        return head
+
+
+    # Fills in the forward links of a head written before they were kept.
+    @classmethod
+    def link_head(cls, path):
+        head = WikiHead.get_by_key_name(path)
+        links = sorted(linkgraph.extract_links(head.content))
+
+        if head.links != links:
+            head.links = links
+            head.put()
+
+        return head
 
 
     @classmethod
     def get_wiki(cls, path, version):
-        wiki = None
+        head = cls.get_head(path)
+
+        if not head or not version or int(version) >= head.version:
+            return head
+
+        wiki = cls.load_revision(path, int(version))
+        if wiki:
+            return wiki
+
+        # revisions written before they were keyed by version: rebuild from the history
         history = cls.wiki_history(path)
+        index = int(version) - 1
+
+        if index >= len(history) or history[index].version != int(version):
+            # history not caught up with the head yet
+            return head
+
+        return history[index]._replace(content=cls.rebuild(history, index))
+
+
+    # Rebuilds an old version from the revisions keyed under the page's head,
+    # fetching only the nearest keyframe and the deltas after it (at most
+    # KEYFRAME_INTERVAL keys) in one batch get. Returns None if the chain back
+    # to a keyframe isn't all keyed under the head.
+    @classmethod
+    def load_revision(cls, path, version):
+        head_key = db.Key.from_path('WikiHead', path)
+        start = version - (version - 1) % revisions.KEYFRAME_INTERVAL
+        keys = [db.Key.from_path('Wiki', str(v), parent=head_key) for v in xrange(start, version + 1)]
+
+        chain = []
+        for wiki in reversed(db.get(keys)):
+            if not wiki:
+                return None
+
+            chain.insert(0, records.wiki_record(wiki))
+            if wiki.delta is None:
+                break
 
-        if history:
-            num_versions = cls.num_versions(path)
+        if chain[0].delta is not None:
+            return None
+
+        return chain[-1]._replace(content=cls.rebuild(chain, len(chain) - 1))
+
+
+    @classmethod
+    def rebuild(cls, history, index):
+        start = index
+        while history[start].delta is not None:
+            start -= 1
+
+        content = history[start].content
+        for wiki in history[start + 1:index + 1]:
+            content = revisions.apply_delta(content, wiki.delta)
 
-            if not version or int(version) > num_versions:
-                wiki = history[num_versions - 1]
-            else:
-                wiki = history[int(version) - 1]
+        return content
 
-        return wiki
+
+    # Revisions never change, so a diff is cached for good once both versions
+    # were actually found (get_wiki falls back to the head while the history
+    # is catching up).
+    @classmethod
+    def get_diff(cls, path, from_version, to_version):
+        key = '%d:%d:%s' % (from_version, to_version, path)
+        return cache.get_or_load(DIFFS, key, lambda: cls.load_diff(path, from_version, to_version))
+
+
+    @classmethod
+    def load_diff(cls, path, from_version, to_version):
+        old = cls.get_wiki(path, from_version)
+        new = cls.get_wiki(path, to_version)
+        result = diff.diff_pages(old.content, new.content)
+
+        if old.version == from_version and new.version == to_version:
+            return result
+        return cache.Uncacheable(result)
+
+
+    @classmethod
+    def history_page(cls, path, cursor=None):
+        q = Wiki.all()
+        q.filter("path =", path)
+        q.order("-version")
+
+        if cursor:
+            try:
+                q.with_cursor(cursor)
+            except (db.BadValueError, db.BadRequestError):
+                return [], None
+
+        wikis = q.fetch(HISTORY_PAGE_SIZE)
+        next_cursor = q.cursor() if len(wikis) == HISTORY_PAGE_SIZE else None
+
+        return [cls.summary(wiki) for wiki in wikis], next_cursor
+
+
+    @classmethod
+    def summary(cls, wiki):
+        length, preview = wiki.length, wiki.preview
+
+        if length is None:
+            # revisions written before summaries existed are all full keyframes
+            length, preview = len(wiki.content), revisions.make_preview(wiki.content)
+
+        return {'version': wiki.version, 'author': wiki.author, 'created': wiki.created,
+                'length': length, 'preview': preview}
 
 
     @classmethod
     def num_versions(cls, path):
-        history = cls.wiki_history(path)
+        head = cls.get_head(path)
 
-        if history:
-            num_versions = len(history)
+        if head:
+            num_versions = head.version
         else:
             num_versions = 0
 
         return num_versions
 
+
+
+# class SearchTerm(db.Model)
+# Defines one shard of a term of the wiki's inverted index.
+
+# postings is a JSON object of {path: count} for the pages whose latest version
+# contains the term. A term's postings are split by page over TERM_SHARDS
+# entities keyed 'term:shard', so a common term never outgrows one entity and
+# edits of different pages mostly write different shards. Searching reads the
+# shards by key only and never looks at Wiki entities.
+
+class SearchTerm(db.Model):
+    postings = db.TextProperty()
+
+
+    @classmethod
+    def shard_keys(cls, term):
+        return [db.Key.from_path('SearchTerm', '%s:%d' % (term, shard)) for shard in xrange(TERM_SHARDS)]
+
+
+    @classmethod
+    def shard_key(cls, term, path):
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        return db.Key.from_path('SearchTerm', '%s:%d' % (term, zlib.crc32(path) % TERM_SHARDS))
+
+
+    @classmethod
+    def get_postings(cls, terms):
+        postings_by_term = cache.get_multi(TERMS, terms)
+        missing = [term for term in terms if term not in postings_by_term]
+
+        if missing:
+            # logging.error('--------------->DB GET -- TERMS: %s' % missing)
+            shards = db.get([key for term in missing for key in cls.shard_keys(term)])
+            loaded = {}
+            for i, term in enumerate(missing):
+                loaded[term] = {}
+                for shard in shards[i * TERM_SHARDS:(i + 1) * TERM_SHARDS]:
+                    if shard:
+                        loaded[term].update(json.loads(shard.postings))
+
+            cache.set_multi(TERMS, loaded)
+            postings_by_term.update(loaded)
+
+        return postings_by_term
+
+
+    # The page's new term counts are first recorded on its IndexedPage, which
+    # also says which terms' postings have to change. Each of those is then
+    # rewritten in its own transaction, so edits of different pages sharing a
+    # term can't overwrite each other's postings.
+    @classmethod
+    def update(cls, path, version, content):
+        counts = search.term_counts(content)
+        terms = db.run_in_transaction(IndexedPage.claim, path, version, counts)
+
+        for term in terms:
+            db.run_in_transaction_options(INDEX_TRANSACTION, cls.update_term, term, path, version,
+                                          counts.get(term, 0))
+
+        db.run_in_transaction(IndexedPage.finish, path, version)
+        cache.delete_multi(TERMS, terms)
+
+
+    # count is the term's count in version. If a later version of the page was
+    # claimed in the meantime, its count is written instead.
+    @classmethod
+    def update_term(cls, term, path, version, count):
+        page = IndexedPage.get_by_key_name(path)
+        if page.version != version:
+            count = json.loads(page.terms).get(term, 0)
+
+        key = cls.shard_key(term, path)
+        shard = SearchTerm.get(key)
+        postings = json.loads(shard.postings) if shard else {}
+
+        if count:
+            postings[path] = count
+        else:
+            postings.pop(path, None)
+
+        if not postings:
+            if shard:
+                shard.delete()
+            return
+
+        data = json.dumps(postings, separators=(',', ':'))
+        if count and len(data) > MAX_POSTINGS_SIZE:
+            logging.error('Not indexing %s for %s: shard %s is full', term, path, key.name())
+            return
+
+        SearchTerm(key=key, postings=data).put()
+
+
+    @classmethod
+    def search(cls, query, page=0):
+        terms = search.query_terms(query)
+
+        if not terms:
+            return [], False
+
+        results = search.rank(cls.get_postings(terms))
+        start = page * SEARCH_PAGE_SIZE
+        shown = results[start:start + SEARCH_PAGE_SIZE]
+
+        versions = cls.current_versions([path for path, score in shown])
+        shown = [(path, versions.get(path), score) for path, score in shown]
+
+        return shown, len(results) > start + SEARCH_PAGE_SIZE
+
+
+    # Postings don't carry versions, so the versions shown with results are
+    # read from the page heads, in one get_multi.
+    @classmethod
+    def current_versions(cls, paths):
+        versions = {}
+        for path, data in cache.get_multi(HEADS, paths).iteritems():
+            head = records.decode_wiki(data)
+            if head:
+                versions[path] = head.version
+
+        for path in paths:
+            if path not in versions:
+                head = Wiki.get_head(path)
+                if head:
+                    versions[path] = head.version
+
+        return versions
+
+
+# class IndexedPage(db.Model)
+# What the search index holds for one page, keyed by the page path: the
+# version last indexed, its term counts (JSON {term: count}) and the terms
+# whose postings that update still has to write (cleared once it's done).
+
+# An update diffs the page's new counts against these rather than against the
+# edit's previous content, and a version older than the recorded one is
+# skipped, so index tasks that run out of order never undo a newer one. A
+# retried task gets the same terms back, and a newer version takes over the
+# terms of an update that hasn't finished.
+
+class IndexedPage(db.Model):
+    version = db.IntegerProperty(required=True, indexed=False)
+    terms = db.TextProperty()
+    pending = db.StringListProperty(indexed=False)
+
+
+    # Records version's counts and returns the terms to rewrite.
+    @classmethod
+    def claim(cls, path, version, counts):
+        page = IndexedPage.get_by_key_name(path)
+
+        if page and page.version > version:
+            return []
+        if page and page.version == version:
+            return list(page.pending)
+
+        old_counts = json.loads(page.terms) if page else {}
+        pending = set(search.changed_terms(old_counts, counts))
+        if page:
+            pending.update(page.pending)
+
+        page = IndexedPage(key_name=path, version=version, terms=json.dumps(counts, separators=(',', ':')),
+                           pending=sorted(pending))
+        page.put()
+        return page.pending
+
+
+    @classmethod
+    def finish(cls, path, version):
+        page = IndexedPage.get_by_key_name(path)
+
+        if page.version == version and page.pending:
+            page.pending = []
+            page.put()
+
+
+# class WikiLinks(db.Model)
+# Defines the reverse link index entry for one wiki path, keyed by that path.
+
+# sources lists the pages whose latest version links to the path. An edit
+# only touches the entries of links that were added or removed in it.
+# The orphan/dead link report compares the keys of this index with the page
+# heads and never looks at page content.
+
+class WikiLinks(db.Model):
+    sources = db.StringListProperty(indexed=False)
+
+
+    @classmethod
+    def get_backlinks(cls, path):
+        sources = cache.get(BACKLINKS, path)
+
+        if sources is None:
+            entity = WikiLinks.get_by_key_name(path)
+            sources = sorted(entity.sources) if entity else []
+            cache.set(BACKLINKS, path, sources)
+
+        return sources
+
+
+    # Each target is updated in its own transaction, so edits of different
+    # pages linking to the same target can't drop each other's backlinks.
+    # Whether path is a source is read from its head's forward links in the
+    # same transaction, so updates for edits of one page that run out of order
+    # still end at its latest links.
+    @classmethod
+    def update(cls, path, old_content, new_content):
+        added, removed = linkgraph.changed_links(old_content, new_content)
+        targets = sorted(added | removed)
+
+        for target in targets:
+            db.run_in_transaction_options(LINK_TRANSACTION, cls.update_target, target, path)
+
+        cache.delete_multi(BACKLINKS, targets)
+
+
+    @classmethod
+    def update_target(cls, target, path):
+        head = WikiHead.get_by_key_name(path)
+        entity = WikiLinks.get_by_key_name(target)
+        sources = set(entity.sources) if entity else set()
+
+        if head and target in head.links:
+            sources.add(path)
+        else:
+            sources.discard(path)
+
+        if sources:
+            WikiLinks(key_name=target, sources=sorted(sources)).put()
+        elif entity:
+            entity.delete()
+
+
+    # Returns (orphans, dead_links): pages nothing links to, and
+    # (missing path, [linking pages]) for links to pages that don't exist.
+    # Recomputed at most every few minutes, while the old report is served.
+    @classmethod
+    def report(cls):
+        return cache.get_or_load(LINK_REPORTS, 'all', cls.build_report)
+
+
+    @classmethod
+    def build_report(cls):
+        pages = set(key.name() for key in WikiHead.all(keys_only=True))
+        targets = set(key.name() for key in WikiLinks.all(keys_only=True))
+
+        dead = sorted(targets - pages)
+        dead_links = []
+        for i in xrange(0, len(dead), 1000):
+            dead_links.extend((entity.key().name(), sorted(entity.sources))
+                              for entity in WikiLinks.get_by_key_name(dead[i:i + 1000]) if entity)
+
+        orphans = sorted(pages - targets - set(['/']))
+        return (orphans, dead_links)
+
+
+# index_edit()
+# Updates the search and link indexes for an edit. Wiki.create defers it once
+# the edit is committed, so a failure here is retried by the task queue and
+# never fails the save itself.
+
+def index_edit(path, version, previous, content):
+    SearchTerm.update(path, version, content)
+    WikiLinks.update(path, previous, content)
+
+
+# index_pages()
+# One-time backfill of the indexes for pages last edited before they existed.
+# For one batch of pages it makes sure the page has a head with its forward
+# links, then adds the page to the link and search indexes as if its latest
+# version were a new edit, and defers itself for the next batch. The updates
+# are idempotent, so running it again (or alongside edits) is harmless.
+
+def index_pages(cursor=None):
+    query = db.Query(Wiki, projection=('path',), distinct=True)
+    if cursor:
+        query.with_cursor(cursor)
+
+    pages = query.fetch(INDEX_BATCH_SIZE)
+    for page in pages:
+        if not Wiki.get_head(page.path):
+            continue
+
+        head = db.run_in_transaction(Wiki.link_head, page.path)
+        index_edit(page.path, head.version, None, head.content)
+
+    cache.invalidate(LINK_REPORTS, 'all')
+
+    if len(pages) == INDEX_BATCH_SIZE:
+        deferred.defer(index_pages, query.cursor())
@@ -0,0 +1,101 @@
+import marshal
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from google.appengine.ext import db
+
+
+# Compact records for what the wiki keeps in memcache.
+#
+# Instead of pickling whole db.Model instances, the cache holds marshalled
+# tuples of just the fields the handlers use, tagged with a format number and
+# record type. Decoding gives back read-only namedtuples; anything that doesn't
+# decode (an older format, or an entity pickled before records existed) reads
+# as a cache miss.
+
+RECORD_FORMAT = 2
+EPOCH = datetime(1970, 1, 1)
+
+
+class UserRecord(namedtuple('UserRecord', 'uid username salt password')):
+    __slots__ = ()
+
+    def key(self):
+        return db.Key.from_path('User', 'u:' + self.username.lower())
+
+
+class WikiRecord(namedtuple('WikiRecord', 'path version author created content delta')):
+    __slots__ = ()
+
+
+def encode_time(dt):
+    if dt is None:
+        return None
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def decode_time(us):
+    if us is None:
+        return None
+    return EPOCH + timedelta(microseconds=us)
+
+
+def user_record(user):
+    uid = user.uid if user.uid is not None else user.key().id()
+    return UserRecord(uid, user.username, user.salt, user.password)
+
+
+def wiki_record(wiki):
+    return WikiRecord(wiki.path, wiki.version, wiki.author, wiki.created,
+                      unicode(wiki.content) if wiki.content is not None else None,
+                      str(wiki.delta) if getattr(wiki, 'delta', None) is not None else None)
+
+
+def dumps(tag, rows):
+    return marshal.dumps((RECORD_FORMAT, tag, rows))
+
+
+def loads(tag, data):
+    if not isinstance(data, str):
+        return None
+
+    try:
+        record_format, record_tag, rows = marshal.loads(data)
+    except (ValueError, EOFError, TypeError):
+        return None
+
+    if record_format != RECORD_FORMAT or record_tag != tag:
+        return None
+
+    return rows
+
+
+def encode_user(user):
+    return dumps('U', tuple(user))
+
+
+def decode_user(data):
+    row = loads('U', data)
+    return UserRecord(*row) if row else None
+
+
+def encode_wikis(wikis):
+    return dumps('W', [(w.path, w.version, w.author, encode_time(w.created), w.content, w.delta) for w in wikis])
+
+
+def decode_wikis(data):
+    rows = loads('W', data)
+    if rows is None:
+        return None
+    return [WikiRecord(p, v, a, decode_time(c), content, delta) for p, v, a, c, content, delta in rows]
+
+
+def encode_wiki(wiki):
+    return encode_wikis([wiki])
+
+
+def decode_wiki(data):
+    wikis = decode_wikis(data)
+    return wikis[0] if wikis else None
@@ -0,0 +1,62 @@
+import difflib
+import json
+import re
+import zlib
+
+
+# Revision storage helpers for the wiki.
+#
+# Every KEYFRAME_INTERVAL-th version of a page is stored in full (a "keyframe"),
+# every other version only stores a forward delta against the version before it.
+# Rebuilding any version therefore never applies more than KEYFRAME_INTERVAL - 1
+# deltas on top of the nearest keyframe.
+#
+# A delta is a zlib-compressed JSON list of ops, applied line by line against the
+# previous content:
+#   [i, j]  -> copy lines i..j (exclusive) of the previous content
+#   "text"  -> insert the given text
+
+KEYFRAME_INTERVAL = 10
+PREVIEW_LENGTH = 80
+
+TAG_RE = re.compile(r'<[^>]*>')
+SPACE_RE = re.compile(r'\s+')
+
+
+def is_keyframe(version):
+    return (int(version) - 1) % KEYFRAME_INTERVAL == 0
+
+
+def make_delta(old, new):
+    old_lines = old.splitlines(True)
+    new_lines = new.splitlines(True)
+    ops = []
+
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j1 != j2:
+            ops.append(''.join(new_lines[j1:j2]))
+
+    return zlib.compress(json.dumps(ops, separators=(',', ':')))
+
+
+def apply_delta(old, delta):
+    old_lines = old.splitlines(True)
+    result = []
+
+    for op in json.loads(zlib.decompress(delta)):
+        if isinstance(op, list):
+            result.extend(old_lines[op[0]:op[1]])
+        else:
+            result.append(op)
+
+    return u''.join(result)
+
+
+def make_preview(content):
+    text = SPACE_RE.sub(' ', TAG_RE.sub(' ', content)).strip()
+    if len(text) > PREVIEW_LENGTH:
+        text = text[:PREVIEW_LENGTH - 3].rstrip() + '...'
+    return text
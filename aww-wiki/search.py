@@ -0,0 +1,64 @@
+import math
+import re
+
+from collections import Counter
+
+
+# Helpers for the wiki's full-text search index.
+#
+# Content is reduced to lowercase word terms (html tags stripped) and their
+# counts. The index itself (term -> postings of path and count) is
+# kept by models.SearchTerm; these functions only tokenize, diff and rank.
+
+TAG_RE = re.compile(r'<[^>]*>')
+TERM_RE = re.compile(r'[a-z0-9]{2,30}')
+
+STOP_WORDS = frozenset(['an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in', 'is',
+                        'it', 'of', 'on', 'or', 'that', 'the', 'this', 'to', 'was', 'with'])
+
+
+def term_counts(content):
+    if not content:
+        return Counter()
+
+    text = TAG_RE.sub(' ', content).lower()
+    return Counter(term for term in TERM_RE.findall(text) if term not in STOP_WORDS)
+
+
+def query_terms(query):
+    return sorted(term_counts(query))
+
+
+# Returns the terms whose posting for a page has to change going from the old
+# counts to the new ones: terms that were added, removed or changed count.
+
+def changed_terms(old_counts, new_counts):
+    terms = set(old_counts) | set(new_counts)
+    return [term for term in terms if old_counts.get(term) != new_counts.get(term)]
+
+
+# Ranks the pages containing every query term.
+# postings_by_term maps each query term to its postings ({path: count}).
+# Returns a list of (path, score) sorted best first.
+
+def rank(postings_by_term):
+    if not postings_by_term or not all(postings_by_term.values()):
+        return []
+
+    max_df = max(len(postings) for postings in postings_by_term.values())
+    by_size = sorted(postings_by_term.values(), key=len)
+
+    results = []
+    for path in by_size[0]:
+        if not all(path in postings for postings in by_size[1:]):
+            continue
+
+        score = 0.0
+        for postings in by_size:
+            idf = math.log(1.0 + float(max_df) / len(postings))
+            score += (1.0 + math.log(postings[path])) * idf
+
+        results.append((path, score))
+
+    results.sort(key=lambda result: (-result[1], result[0]))
+    return results
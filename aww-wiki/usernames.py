@@ -0,0 +1,88 @@
+import cache
+import hashlib
+import struct
+
+from google.appengine.api import memcache
+
+
+# Existence filter for taken usernames, shared by every instance through memcache.
+#
+# A Bloom filter answers "definitely not taken" without any datastore work, and
+# "maybe taken" for everything it has seen (plus about 1% false positives),
+# which the caller then confirms with a key get. The filter is rebuilt from the
+# User entities whenever it's missing from memcache, by one request while the
+# others wait for it, and User.create adds the new name with compare-and-set;
+# if that keeps losing races the filter is dropped so the next check rebuilds
+# it rather than trusting a stale copy.
+#
+# Availability checks are advisory: the rebuild query is eventually consistent,
+# so a name created a moment earlier may read as free. User.create still checks
+# the name again inside its transaction.
+
+FILTER = cache.Namespace('usernames', ttl=24 * 3600)
+FILTER_BITS = 1 << 19    # ~50,000 names at a 1% false positive rate
+FILTER_HASHES = 7
+UPDATE_RETRIES = 5
+
+
+class BloomFilter(object):
+    def __init__(self, bits=None, size=FILTER_BITS, hashes=FILTER_HASHES):
+        self.size = size
+        self.hashes = hashes
+        self.bits = bytearray(bits) if bits is not None else bytearray(size // 8)
+
+    # Double hashing: the k positions are h1 + i*h2 for two halves of one MD5.
+    def positions(self, name):
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(name).digest())
+        return [(h1 + i * h2) % self.size for i in xrange(self.hashes)]
+
+    def add(self, name):
+        for position in self.positions(name):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, name):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(name))
+
+    def dumps(self):
+        return str(self.bits)
+
+
+def load_filter(data):
+    if not isinstance(data, str) or len(data) != FILTER_BITS // 8:
+        return None
+    return BloomFilter(data)
+
+
+# Returns the shared filter, rebuilt from names() (a callable giving every
+# normalized name) through cache.get_or_load when it's missing.
+
+def get_filter(names):
+    return cache.get_or_load(FILTER, 'taken', lambda: build_filter(names()), load_filter)
+
+
+def build_filter(names):
+    bloom = BloomFilter()
+    for name in names:
+        bloom.add(name)
+
+    return bloom.dumps()
+
+
+def add_name(name):
+    client = memcache.Client()
+    for i in xrange(UPDATE_RETRIES):
+        bloom = load_filter(cache.get(FILTER, 'taken', client))
+        if bloom is None:
+            return # rebuilt from storage on the next check
+
+        bloom.add(name)
+        if cache.set(FILTER, 'taken', bloom.dumps(), 'cas', client):
+            return
+
+    cache.delete(FILTER, 'taken', client)
+
+
+def reset_filter():
+    cache.delete(FILTER, 'taken')
@@ -1,4 +1,9 @@
 import re
+import hmac
+import time
+import hashlib
+
+from collections import namedtuple
 
 
 # class regexChecking()
@@ -29,3 +34,43 @@ class regexChecking():
 		return EMAIL_RE.match(email)
 
 
+
+# Session tokens
+# A session is carried entirely in the user_id cookie as
+#   username|uid|expires|signature
+# where signature is an HMAC-SHA256 of the rest under the app's secret, so a
+# request's identity is checked without any storage lookup.
+#
+# read_session_token returns a Session for a valid, unexpired token, else None.
+
+SESSION_LIFETIME = 30 * 24 * 3600
+
+Session = namedtuple('Session', 'username uid expires')
+
+def sign(value, secret):
+	return hmac.new(secret, value, hashlib.sha256).hexdigest()
+
+def make_session_token(username, uid, secret, now=None):
+	expires = int(now or time.time()) + SESSION_LIFETIME
+	value = '%s|%d|%d' % (username, uid, expires)
+	return '%s|%s' % (value, sign(value, secret))
+
+def read_session_token(token, secret, now=None):
+	if not token:
+		return None
+
+	try:
+		parts = str(token).split('|')
+	except UnicodeError:
+		return None
+
+	if len(parts) != 4 or not parts[1].isdigit() or not parts[2].isdigit():
+		return None
+
+	username, uid, expires, signature = parts
+	if not hmac.compare_digest(sign('|'.join(parts[:3]), secret), signature):
+		return None
+	if int(expires) < (now or time.time()):
+		return None
+
+	return Session(username, int(uid), int(expires))